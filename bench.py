@@ -0,0 +1,361 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from pydub import AudioSegment
+from core import Song, LiveSong, Segment, CUTOFF, POLLING_INTERVAL, LENIENCY, \
+    PEAK_CRITERIA, SPACING, LOUDNESS_WINDOW
+from decode import audio_blocks
+from dsp import StreamAnalyzer
+from instrument import Stats
+
+
+BASELINE = './bench_baseline.json'
+RATE = 44100
+
+SUITES = {
+    'quick': [
+        ('gated', 30, 128), ('kick', 30, 90), ('click', 30, 140)
+    ],
+    'full': [
+        ('gated', 30, 128), ('kick', 30, 90), ('click', 30, 140),
+        ('click', 300, 128), ('noise', 300, 90)
+    ],
+    'long': [
+        ('gated', 300, 128), ('gated', 1200, 128), ('gated', 3600, 128)
+    ]
+}
+
+# Block length of the live replay, in seconds.
+LIVE_BLOCK = 0.05
+
+# A peak within this many ms of a beat counts as finding it.
+TOLERANCE = 50
+
+
+def fixture(kind, seconds, bpm, seed=0, rate=RATE):
+    # Deterministic synthetic track and its beat times in ms.
+    #   gated: a bass line that drops out for 30 ms on every beat
+    #   kick:  kicks over a bass line ducked by a sidechain on every beat
+    #   click: short clicks over a ducked tone
+    #   noise: kicks over a ducked noise bed
+    rng = np.random.default_rng(seed)
+    frames = int(seconds * rate)
+    t = np.arange(frames) / rate
+    beats = np.arange(0, seconds, 60 / bpm)
+
+    if kind == 'gated':
+        x = 9000 * np.sin(2 * np.pi * 70 * t)
+        x *= 1 + 0.3 * np.sin(2 * np.pi * 0.1 * t)
+        x += rng.normal(0, 300, frames)
+        for beat in beats:
+            start = int(beat * rate)
+            x[start:start + int(0.03 * rate)] *= 0.02
+    else:
+        if kind == 'noise':
+            x = rng.normal(0, 6000, frames)
+        else:
+            x = 8000 * np.sin(2 * np.pi * (55 if kind == 'kick' else 80) * t)
+        last = np.searchsorted(beats, t, side='right') - 1
+        since = t - beats[np.maximum(last, 0)]
+        x *= 1 - 0.98 * np.exp(-since / 0.05)
+
+        length, decay = (0.005, 400) if kind == 'click' else (0.15, 60)
+        hit = np.arange(int(length * rate)) / rate
+        sweep = 60 + 80 * np.exp(-hit * 40)
+        sound = 16000 * np.exp(-hit * decay) * np.sin(2 * np.pi * sweep * hit)
+        for beat in beats:
+            start = int(beat * rate)
+            end = min(frames, start + len(sound))
+            x[start:end] += sound[:end - start]
+
+    data = np.clip(x, -32768, 32767).astype(np.int16)
+    data = np.stack([data, (data * 0.8).astype(np.int16)], axis=1)
+    audio = AudioSegment(
+        data=data.tobytes(), sample_width=2, frame_rate=rate, channels=2
+    )
+    return audio, beats * 1000
+
+
+def recall(peaks, beats):
+    if not len(beats):
+        return 0.0
+    times = np.sort(np.array([p.time for p in peaks]))
+    if not len(times):
+        return 0.0
+    positions = np.clip(np.searchsorted(times, beats), 1, len(times) - 1)
+    nearest = np.minimum(
+        np.abs(times[positions - 1] - beats), np.abs(times[positions] - beats)
+    )
+    if len(times) == 1:
+        nearest = np.abs(times[0] - beats)
+    return float(np.mean(nearest <= TOLERANCE))
+
+
+def digest(song):
+    # Fingerprint of the analysis output, to show a speedup changed nothing.
+    h = hashlib.sha1()
+    h.update(repr([(p.time, p.amplitude) for p in song.peaks]).encode())
+    h.update(repr(song.bpm).encode())
+    h.update(json.dumps(song.level_json()).encode())
+    return h.hexdigest()[:16]
+
+
+def reference_peaks(low):
+    # The original pydub segments and per-segment peak loop, kept as the
+    # reference the NumPy envelope, loudness index and detect_peaks must
+    # match. `low` is the low-passed AudioSegment.
+    segments = [
+        Segment(i + POLLING_INTERVAL / 2, abs(low[i:i+POLLING_INTERVAL].dBFS))
+        for i in range(0, len(low), POLLING_INTERVAL)
+    ]
+    result = []
+    last_peak = 0
+    for i in range(1, len(segments)-1):
+        cur = segments[i]
+        delta = cur.time - last_peak
+        left = segments[i-LENIENCY:i]
+        right = segments[i+1:i+LENIENCY+1]
+        sides = left + right
+
+        # Louder than all adjacent segments.
+        if not all(cur.amplitude > s.amplitude for s in sides):
+            continue
+
+        # Distinct from at least one segment on either side.
+        distinct = lambda s: s.amplitude < cur.amplitude * 0.75
+        if not (sum(map(distinct, left)) >= 1 and
+                sum(map(distinct, right)) >= 1):
+            continue
+
+        # All near segments above the loudness threshold of the frame.
+        before, after = LOUDNESS_WINDOW
+        loudness = abs(low[cur.time-before:cur.time+after].dBFS)
+        if not all(s.amplitude > loudness * 0.5 for s in sides):
+            continue
+
+        if not delta >= SPACING:
+            continue
+
+        result.append(cur)
+        last_peak = cur.time
+    return result
+
+
+def stream_peaks(audio):
+    analyzer = StreamAnalyzer(
+        audio.frame_rate, audio.channels, audio.sample_width, CUTOFF,
+        POLLING_INTERVAL, LENIENCY, PEAK_CRITERIA, SPACING, LOUDNESS_WINDOW
+    )
+    found = []
+    for block in audio_blocks(audio):
+        found += analyzer.feed(block)
+    return found + analyzer.finish()
+
+
+def live_chart(audio, bpm, difficulty, seconds=LIVE_BLOCK):
+    # Replays the track in blocks the size of an audio device buffer.
+    live = LiveSong(
+        audio.frame_rate, audio.channels, audio.sample_width, bpm, difficulty
+    )
+    for block in audio_blocks(audio, seconds):
+        live.feed(block)
+    live.finish()
+    return live
+
+
+def startup(repeat):
+    # Best wall time of a fresh interpreter running `main.py --help`, and of
+    # one importing everything a conversion needs.
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def best(args):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable] + args, cwd=here, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    return {
+        'full': best(['main.py', '--help']),
+        'import': best(['-c', 'import core, pydub'])
+    }
+
+
+def run(kind, seconds, bpm, repeat, stream, live, reference):
+    audio, beats = fixture(kind, seconds, bpm)
+    result = {'seconds': seconds, 'bpm_true': bpm}
+
+    # Whole pipeline, uninstrumented, best of `repeat`.
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        song = Song(kind, audio)
+        song.chart
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result['full'] = best
+    result['throughput'] = seconds / best
+
+    stats = Stats(enabled=True)
+    song = Song(kind, audio, stats=stats)
+    song.chart
+    with stats.stage('json'):
+        for _, write in song.map_files():
+            write(io.BytesIO())
+    if shutil.which(AudioSegment.converter):
+        with tempfile.TemporaryDirectory() as tmp:
+            with stats.stage('encode'):
+                song.audio.export(f'{tmp}/out.ogg', format='ogg')
+    if stream:
+        with stats.stage('stream'):
+            found = stream_peaks(audio)
+        result['stream_matches'] = \
+            found == [(p.time, p.amplitude) for p in song.peaks]
+    if reference:
+        with stats.stage('reference'):
+            low = song.audio._spawn(song.low_pass.data.tobytes())
+            found = reference_peaks(low)
+        result['reference_matches'] = \
+            [(p.time, p.amplitude) for p in found] == \
+            [(p.time, p.amplitude) for p in song.peaks]
+    if live:
+        # Given the offline BPM, the live chart must be the offline one.
+        difficulty = song.difficulties[-1]
+        replay = live_chart(audio, song.bpm, difficulty)
+        result['live_matches'] = \
+            replay.chart.json() == song.charts[difficulty].json()
+        result['live'] = replay.latency()
+
+    result['stages'] = stats.stages
+    result['counts'] = stats.counts
+    result['peak_memory'] = max(s['memory'] for s in stats.stages.values())
+    result['bpm'] = song.bpm
+    result['bpm_error'] = abs(song.bpm - bpm) / bpm
+    result['recall'] = recall(song.peaks, beats)
+    result['digest'] = digest(song)
+    return result
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if result.get('stream_matches') is False:
+            regressions.append(f'{name}: streaming peaks differ')
+        if result.get('reference_matches') is False:
+            regressions.append(f'{name}: peaks differ from the reference')
+        if result.get('live_matches') is False:
+            regressions.append(f'{name}: live chart differs')
+        if 'error' in result:
+            if base and 'error' not in base:
+                regressions.append(f'{name}: now fails')
+            continue
+        if not base or 'error' in base:
+            continue
+        ratio = result['full'] / base['full']
+        result['vs_baseline'] = ratio
+        if ratio > threshold:
+            regressions.append(f'{name}: {ratio:.2f}x slower')
+        if result.get('digest') != base.get('digest'):
+            regressions.append(f'{name}: output changed')
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline.')
+    parser.add_argument('--suite', choices=SUITES, default='quick')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument(
+        '--save', action='store_true', help='store results as the baseline'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=1.25,
+        help='slowdown ratio against the baseline that counts as a regression'
+    )
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='also time the streaming analyzer and check it matches'
+    )
+    parser.add_argument(
+        '--reference', action='store_true',
+        help='also run the original per-segment peak loop and check it '
+        'matches'
+    )
+    parser.add_argument(
+        '--live', action='store_true',
+        help='also replay each track through LiveSong and check its chart'
+    )
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args(argv)
+
+    results = {'startup': startup(args.repeat)}
+    print(
+        f'startup: cli={results["startup"]["full"]:.3f}s '
+        f'import={results["startup"]["import"]:.3f}s'
+    )
+    for kind, seconds, bpm in SUITES[args.suite]:
+        name = f'{kind}-{seconds}s-{bpm}bpm'
+        try:
+            result = run(
+                kind, seconds, bpm, args.repeat, args.stream, args.live,
+                args.reference
+            )
+        except Exception as e:
+            print(f'{name}: failed ({type(e).__name__}: {e})')
+            results[name] = {'error': repr(e)}
+            continue
+        results[name] = result
+        stages = ' '.join(
+            f'{stage}={s["wall"]:.3f}s'
+            for stage, s in result['stages'].items()
+        )
+        print(
+            f'{name}: {result["full"]:.3f}s '
+            f'({result["throughput"]:.0f}x realtime, '
+            f'{result["peak_memory"] / 2 ** 20:.0f} MiB) '
+            f'bpm={result["bpm"]:.1f} recall={result["recall"]:.2f} '
+            f'{stages}'
+        )
+        if 'live' in result:
+            live = result['live']
+            print(
+                f'  live: {live["realtime"]:.0f}x realtime, '
+                f'block max={live["block_max"] * 1000:.1f}ms, '
+                f'note delay p50={live["delay_p50"]:.0f}ms '
+                f'max={live["delay_max"]:.0f}ms'
+            )
+
+    try:
+        with open(args.baseline) as fr:
+            baseline = json.load(fr)
+    except FileNotFoundError:
+        baseline = {}
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+
+    if args.output:
+        with open(args.output, 'w') as fr:
+            json.dump(results, fr, indent=2)
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as fr:
+            json.dump(baseline, fr, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
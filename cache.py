@@ -0,0 +1,206 @@
+import os
+import struct
+import shutil
+import hashlib
+import zipfile
+import threading
+import numpy as np
+from dsp import DTYPES, Samples
+
+
+CACHE_DIR = './cache'
+CACHE_SIZE = 256 * 1024 * 1024
+AUDIO_CACHE_SIZE = 1024 * 1024 * 1024
+PCM_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Header of a decoded PCM entry: magic, frame rate, channels, sample width,
+# frames, and the size and modification time (ns) of the source. The
+# samples start at PCM_OFFSET.
+PCM_MAGIC = b'PCMCACH1'
+PCM_HEADER = struct.Struct('<8sIHHQQq')
+PCM_OFFSET = 64
+
+
+def audio_hash(audio, *params):
+    digest = hashlib.sha1()
+    header = (audio.frame_rate, audio.channels, audio.sample_width) + params
+    digest.update(repr(header).encode())
+    digest.update(audio.raw_data)
+    return digest.hexdigest()
+
+
+def file_hash(filename, *params):
+    digest = hashlib.sha1()
+    digest.update(repr(params).encode())
+    with open(filename, 'rb') as fr:
+        for block in iter(lambda: fr.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_key(filename, *params):
+    # Names a file's entry without reading it. The entry records the state
+    # of the source it was made from, see PCMCache.
+    digest = hashlib.sha1()
+    digest.update(repr((os.path.abspath(filename),) + params).encode())
+    return digest.hexdigest()
+
+
+def link(source, destination):
+    # Hard-links a cached file into place, or copies it where links are not
+    # possible. Returns False when the destination already is that file.
+    if os.path.exists(destination) and \
+            os.path.samefile(source, destination):
+        return False
+    tmp = f'{destination}.{os.getpid()}.tmp'
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+    return True
+
+
+class Cache:
+    # Directory of files named by key. Reads refresh the modification time
+    # and writes evict the least recently used files above max_size bytes.
+    def __init__(self, path, suffix, max_size=CACHE_SIZE):
+        self.path = path
+        self.suffix = suffix
+        self.max_size = max_size
+
+    def file(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def touch(self, key):
+        path = self.file(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def write(self, key, write):
+        # `write` gets an open binary file.
+        def create(tmp):
+            with open(tmp, 'wb') as fr:
+                write(fr)
+        return self.create(key, create)
+
+    def create(self, key, create):
+        # `create` gets a temporary path to produce the entry at, for
+        # writers such as encoders that want a filename.
+        os.makedirs(self.path, exist_ok=True)
+        path = self.file(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            create(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+        return path
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class AnalysisCache(Cache):
+    def __init__(self, path=f'{CACHE_DIR}/analysis', max_size=CACHE_SIZE):
+        super().__init__(path, '.npz', max_size)
+
+    def get(self, key):
+        path = self.touch(key)
+        if path is None:
+            return None
+        try:
+            with np.load(path) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            return None
+
+    def put(self, key, analysis):
+        return self.write(key, lambda fr: np.savez(fr, **analysis))
+
+
+class AudioCache(Cache):
+    # Encoded audio keyed by its source and the encoder settings.
+    def __init__(self, path=f'{CACHE_DIR}/audio', suffix='.ogg',
+                 max_size=AUDIO_CACHE_SIZE):
+        super().__init__(path, suffix, max_size)
+
+    def get(self, key):
+        return self.touch(key)
+
+    def put(self, key, encode):
+        return self.create(key, encode)
+
+
+class PCMCache(Cache):
+    # Decoded audio as raw PCM behind a small header. Reads memory-map the
+    # file, so the samples are views of the page cache rather than copies.
+    # An entry made from an older version of the source is a miss, and is
+    # replaced by the next put.
+    def __init__(self, path=f'{CACHE_DIR}/pcm', max_size=PCM_CACHE_SIZE):
+        super().__init__(path, '.pcm', max_size)
+
+    def get(self, key, source):
+        path = self.touch(key)
+        if path is None:
+            return None
+        stat = os.stat(source)
+        try:
+            with open(path, 'rb') as fr:
+                header = PCM_HEADER.unpack(fr.read(PCM_HEADER.size))
+        except (OSError, struct.error):
+            return None
+        magic, frame_rate, channels, sample_width, frames, size, mtime = \
+            header
+        if magic != PCM_MAGIC or sample_width not in DTYPES or \
+                (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        dtype = DTYPES[sample_width]
+        if not frames:
+            data = np.zeros((0, channels), dtype=dtype)
+        else:
+            try:
+                data = np.memmap(
+                    path, dtype=dtype, mode='r', offset=PCM_OFFSET,
+                    shape=(frames, channels)
+                )
+            except (OSError, ValueError):
+                # Truncated.
+                return None
+        return Samples(data, frame_rate, sample_width)
+
+    def put(self, key, source, samples):
+        # `source` is the file the samples were decoded from.
+        stat = os.stat(source)
+        header = PCM_HEADER.pack(
+            PCM_MAGIC, samples.frame_rate, samples.channels,
+            samples.sample_width, len(samples.data), stat.st_size,
+            stat.st_mtime_ns
+        )
+
+        def write(fr):
+            fr.write(header.ljust(PCM_OFFSET, b'\0'))
+            fr.write(np.ascontiguousarray(samples.data).data)
+        return self.write(key, write)
@@ -1,140 +1,469 @@
+import io
 import os
 import math
-import json
+import time
 import random
-from shutil import rmtree
-from data import Note, NoteType, CutDirection, directions, patterns
+import filecmp
+from itertools import accumulate
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from data import Chart, NoteType, CutDirection, directions, \
+    difficulties, max_pattern_length
+from cache import audio_hash, file_hash, link
+from zipfile import ZipInfo, ZIP_DEFLATED, ZIP_STORED
+from decode import read_pcm, transcode, transcode_bytes, write_wav, \
+    encode_pcm
+from instrument import Stats
+from serialize import PRECISION, write_json, write_level
+from spectral import BANDS, onsets
+from tempo import estimate_tempo
+from dsp import LoudnessIndex, StreamAnalyzer, as_samples, low_pass, \
+    detect_peaks, splice_blocks, louder_than_neighbours, \
+    distinct_from_neighbours, above_loudness
 
 
 POLLING_INTERVAL = 10
 LENIENCY = 8
+SPACING = 10
+CUTOFF = 120.0
+
+# Bump when a change to the analysis invalidates cached results.
+ANALYSIS_VERSION = 2
+
+# Format of the exported audio. Part of the audio cache key.
+AUDIO_FORMAT = 'ogg'
+
+# Below this tempo confidence the BPM falls back to the median interval
+# between peaks.
+MIN_CONFIDENCE = 0.1
+
+# Band onsets closer than this to a kept peak are dropped, in ms.
+ONSET_GAP = 50
+
+# Loudness context around each segment, in ms.
+LOUDNESS_WINDOW = (3000, 5000)
+
+# Audio kept before and after each peak by Song.splice, in ms.
+SPLICE_WINDOW = (50, 50)
+
+PEAK_CRITERIA = [
+    # Segment louder than all adjacent segments.
+    louder_than_neighbours,
+    # Distinction between current segment and adjacent segments.
+    distinct_from_neighbours(0.75),
+    # All near segments are above loudness threshold for the frame.
+    above_loudness(0.5)
+]
 
 
 class Segment:
-    def __init__(self, time, amplitude):
+    def __init__(self, time, amplitude, band=None):
         self.time = time
         self.amplitude = amplitude
+        # Name of the spectral band of an onset, None for loudness peaks.
+        self.band = band
 
     def __repr__(self):
         return f'{self.time}: {self.amplitude}'
 
 
+class derived:
+    # A Song artifact computed on first access and memoized on the instance.
+    # `depends` names the parameters and artifacts it is derived from;
+    # assigning any of them drops it and everything downstream of it.
+    def __init__(self, *depends):
+        self.depends = depends
+
+    def __call__(self, compute):
+        self.compute = compute
+        return self
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        owner._derived = dict(getattr(owner, '_derived', {}), **{name: self})
+
+    def __get__(self, song, owner):
+        if song is None:
+            return self
+        with song.stats.stage(self.name):
+            value = self.compute(song)
+        # Stored under the same name, so later reads skip the descriptor.
+        song.__dict__[self.name] = value
+        return value
+
+
 class Song:
-    def __init__(self, name, audio):
+    # Parameters; assigning one drops the artifacts that depend on it.
+    parameters = (
+        'cutoff', 'polling_interval', 'leniency', 'spacing', 'difficulties',
+        'precision', 'compat', 'bands', 'align', 'seed'
+    )
+    cutoff = CUTOFF
+    polling_interval = POLLING_INTERVAL
+    leniency = LENIENCY
+    spacing = SPACING
+    # Names from data.difficulties, easiest first.
+    difficulties = tuple(difficulties)
+    # Names from spectral.BANDS whose onsets join the peaks, if any.
+    bands = ()
+    # Whether to shift the beat grid onto the detected beats through
+    # _songTimeOffset.
+    align = False
+    # Seed of the chart pass; the same seed gives the same charts.
+    seed = 1
+    # How the JSON files are written, see serialize.write_level.
+    precision = PRECISION
+    compat = False
+
+    def __init__(self, name, audio, cache=None, stats=None, **params):
+        self.stats = stats or Stats()
         self.name = name
         self.audio = audio
-        self.low_pass = self.audio.low_pass_filter(120.0)
-        self.loudness = abs(self.low_pass.dBFS)
-        self.segments = segments(self.low_pass, POLLING_INTERVAL)
-        self.peaks = peaks(self.low_pass, self.segments)
-        self.bpm = self._calculate_bpm()
-        self.chart = self.create_level()
-
-    def splice(self):
-        result = self.audio[0:1]
-        for s in self.peaks:
-            result += self.audio[s.time-50:s.time+50]
-        return result
-
-    def create_level(self):
-        random.seed(1)
-        max_pattern_length = max(len(p.timings) for p in patterns.values())
-
-        level = []
-        i = 0
-        last_note = None
-        while i < len(self.peaks):
-            options = []
-            nxt = []
-            peak = self.peaks[i]
-
-            # Try to find pattern.
-            for length in range(1, max_pattern_length + 1):
-                # Make sure we don't go out of bounds.
-                if i + length >= len(self.peaks):
-                    continue
-    
-                matching = [
-                    p for p in patterns.values() if len(p.timings[0]) == length
-                ]
-                for match in matching:
-                    times = [p.time for p in self.peaks[i:i+length]]
-                    r = [0.0] + [get_range(t) for t in change(times)]
-                    ranges = [sum(r[:k]) + r[k] for k in range(len(r))]
-
-                    # Make sure the intervals match
-                    if count(match.timings, lambda x: ranges == x) == 0:
-                        continue
-
-                    # Make sure we don't change directions abruptly
-                    first = match.notes[0][0]
-                    if last_note and \
-                        not first.direction in directions[last_note.direction]:
-                        continue
-
-                    options.append(match.notes)
-      
-            # Do we have options
-            if options:
-                choice = random.choice(options)
-                for c in range(len(choice)):
-                    for note in choice[c]:
-                        nxt.append(Note(
-                            note.type,
-                            self.adjusted_time(self.peaks[i+c].time),
-                            note.row, note.col,
-                            note.direction
-                        ))
-                i += len(choice)
-
-            if not nxt:
-                # Resort to randomness if we can't find a matching pattern.
-                row = random.randint(0, 2)
-                time = self.adjusted_time(peak.time)
-                note_type = random.choice([NoteType.blue, NoteType.red])
-                direction = CutDirection(random.randint(0, 7))
-                col = random.randint(0, 1)
-                if note_type == NoteType.blue:
-                    col = random.randint(2, 3)
-
-                if i-1 >= 0:
-                    last_note = level[len(level)-1]
-                    direction = random.choice(
-                        directions[last_note.direction]
-                    )
-
-                nxt = [Note(note_type, time, row, col, direction)]
-                i += 1
+        self.source = None
+        self.cache = cache
+        for param, value in params.items():
+            if param not in self.parameters:
+                raise TypeError(f'Unknown parameter {param}')
+            setattr(self, param, value)
+
+    def __setattr__(self, name, value):
+        if name == 'difficulties' and not value:
+            raise ValueError('At least one difficulty is needed')
+        super().__setattr__(name, value)
+        self.invalidate(name)
+
+    def invalidate(self, name):
+        for artifact in self._derived.values():
+            if name in artifact.depends:
+                self.__dict__.pop(artifact.name, None)
+                self.invalidate(artifact.name)
+
+    @classmethod
+    def stream(cls, name, filename, stats=None, **params):
+        # Analyzes the file block by block without keeping the decoded
+        # audio, for long mixes. Export transcodes straight from the file.
+        # The peaks match the in-memory path for 16-bit sources; read_pcm
+        # always decodes to 16 bits, while from_file keeps 24-bit audio as
+        # 32-bit samples, so deeper sources come out slightly different.
+        # Band onsets need the whole track at once and are not supported.
+        song = cls(name, None, stats=stats, **params)
+        if song.bands:
+            raise ValueError('Spectral bands cannot be used when streaming')
+        frame_rate, channels, sample_width, blocks = read_pcm(filename)
+        analyzer = StreamAnalyzer(
+            frame_rate, channels, sample_width, song.cutoff,
+            song.polling_interval, song.leniency, PEAK_CRITERIA, song.spacing,
+            LOUDNESS_WINDOW, keep_envelope=True
+        )
+        found = []
+        with song.stats.stage('stream'):
+            for block in blocks:
+                found += analyzer.feed(block)
+            found += analyzer.finish()
+
+        # Seed what the blocks gave us; the rest derives from the peaks.
+        song.source = filename
+        song.peaks = [Segment(time, amplitude) for time, amplitude in found]
+        song.stats.count('peaks', len(song.peaks))
+        song.envelope = np.concatenate([np.empty(0)] + analyzer.envelope)
+        song.loudness = abs(analyzer.dBFS)
+        song.duration = analyzer.frames / frame_rate
+        return song
+
+    @derived('audio')
+    def duration(self):
+        return len(self.audio) / 1000
+
+    @derived('audio')
+    def samples(self):
+        return as_samples(self.audio)
+
+    @derived('samples', 'cutoff')
+    def low_pass(self):
+        return low_pass(self.samples, self.cutoff)
+
+    @derived('low_pass')
+    def index(self):
+        return LoudnessIndex(self.low_pass)
+
+    @derived('cache', 'audio', 'cutoff', 'polling_interval', 'leniency',
+             'spacing')
+    def cached(self):
+        # Analysis results from the cache, or None. Artifacts that read it
+        # depend on the cache itself rather than on this, so a parameter
+        # change only drops what the parameter actually affects. Onsets are
+        # not cached, so neither is anything when bands are used.
+        if self.cache is None or self.bands:
+            return None
+        return self.cache.get(self.analysis_key())
+
+    @derived('cache', 'index')
+    def loudness(self):
+        if self.cached is not None:
+            return self.cached['loudness'].item()
+        return abs(self.index.dBFS)
+
+    @derived('cache', 'index', 'polling_interval')
+    def segments(self):
+        if self.cached is not None:
+            found = [
+                Segment(time, amplitude) for time, amplitude in zip(
+                    self.cached['times'].tolist(),
+                    self.cached['amplitudes'].tolist()
+                )
+            ]
+        else:
+            found = segments(
+                self.low_pass, self.polling_interval, index=self.index
+            )
+        self.stats.count('segments', len(found))
+        return found
+
+    @derived('samples', 'bands')
+    def onsets(self):
+        # One STFT pass gives the onsets of every band.
+        found = [
+            Segment(time, strength, band)
+            for time, strength, band in onsets(self.samples, self.bands)
+        ]
+        self.stats.count('onsets', len(found))
+        return found
+
+    @derived('cache', 'segments', 'index', 'leniency', 'spacing', 'onsets')
+    def peaks(self):
+        if self.cached is not None:
+            found = [self.segments[i] for i in self.cached['peaks'].tolist()]
+        else:
+            found = peaks(
+                self.low_pass, self.segments, leniency=self.leniency,
+                spacing=self.spacing, index=self.index
+            )
+        if self.bands:
+            found = merge_onsets(found, self.onsets)
+        self.stats.count('peaks', len(found))
+        return found
+
+    @derived('segments')
+    def envelope(self):
+        return np.array([s.amplitude for s in self.segments])
+
+    @derived('envelope', 'polling_interval')
+    def tempo(self):
+        # (bpm, confidence, phase in ms) from the autocorrelation of the
+        # envelope.
+        return estimate_tempo(self.envelope, self.polling_interval)
+
+    @derived('cache', 'tempo', 'peaks')
+    def bpm(self):
+        if self.cached is not None:
+            return self.cached['bpm'].item()
+        bpm = pick_bpm(self.tempo, [peak.time for peak in self.peaks])
+        if self.cache is not None and not self.bands:
+            # The BPM is the last analysis artifact, so store them all now.
+            with self.stats.stage('cached'):
+                self.cache.put(self.analysis_key(), self._analysis(bpm))
+        return bpm
 
-            level += nxt
-            last_note = level[len(level)-1]
+    @derived('tempo', 'align')
+    def offset(self):
+        # Time of the first beat in seconds when aligning, which is only
+        # meaningful when the BPM came from the same estimate.
+        if not self.align:
+            return 0
+        bpm, confidence, phase = self.tempo
+        if bpm is None or confidence < MIN_CONFIDENCE:
+            return 0
+        return phase / 1000
+
+    @derived('peaks', 'bpm', 'difficulties', 'offset', 'seed')
+    def charts(self):
+        # Every difficulty shares the analysis; only the cheap chart pass
+        # runs per difficulty.
+        # Resolved up front so the threads only ever read them.
+        self.peaks, self.bpm, self.offset
+        with ThreadPoolExecutor(len(self.difficulties)) as pool:
+            charts = dict(zip(self.difficulties, pool.map(
+                lambda name: self.create_level(difficulties[name]),
+                self.difficulties
+            )))
+        self.stats.count('notes', sum(len(c) for c in charts.values()))
+        return charts
+
+    @derived('charts')
+    def chart(self):
+        # The hardest chart.
+        return self.charts[self.difficulties[-1]]
+
+    def analysis_key(self):
+        return audio_hash(
+            self.audio, ANALYSIS_VERSION, self.polling_interval,
+            self.leniency, self.spacing, self.cutoff, LOUDNESS_WINDOW
+        )
+
+    def _analysis(self, bpm):
+        # Everything needed to rebuild the Song without the audio pipeline.
+        positions = {id(s): i for i, s in enumerate(self.segments)}
+        return {
+            'times': np.array([s.time for s in self.segments]),
+            'amplitudes': np.array([s.amplitude for s in self.segments]),
+            'peaks': np.array(
+                [positions[id(p)] for p in self.peaks], dtype=np.int64
+            ),
+            'loudness': np.asarray(self.loudness),
+            'bpm': np.asarray(bpm)
+        }
 
-        return level
+    def splice(self, clicks=False, crossfade=0):
+        # The first millisecond, then SPLICE_WINDOW around every peak. See
+        # dsp.splice_blocks for the options.
+        empty = self.samples.data[:0]
+        data = np.concatenate(
+            [empty] + list(self._splice_blocks(clicks, crossfade))
+        )
+        return self.audio._spawn(data.tobytes())
+
+    def write_splice(self, path, format='wav', clicks=False, crossfade=0):
+        # Like splice(), but streamed to the file without building it.
+        samples = self.samples
+        blocks = self._splice_blocks(clicks, crossfade)
+        args = (
+            blocks, path, samples.frame_rate, samples.channels,
+            samples.sample_width
+        )
+        if format == 'wav':
+            write_wav(*args)
+        else:
+            encode_pcm(*args, format=format)
+
+    def _splice_blocks(self, clicks, crossfade):
+        before, after = SPLICE_WINDOW
+        windows = [(0, 1)] + [
+            (s.time - before, s.time + after) for s in self.peaks
+        ]
+        yield from splice_blocks(self.samples, windows, clicks, crossfade)
+
+    def create_level(self, difficulty=None):
+        return generate_chart(
+            self.peaks, self.bpm, difficulty or difficulties['Expert'],
+            self.seed, self.offset, self.stats
+        )
 
     def adjusted_time(self, time):
         beat_time = (1 / self.bpm) * 60 * 1000
-        return time / beat_time
-
-    def export(self):
-        outdir, songdir = './output', f'./output/ai_{self.name}'
-        infopath, datapath = f'{songdir}/info.dat', f'{songdir}/Expert.dat'
-        if not os.path.exists(outdir):
-            os.mkdir(outdir)
-        if os.path.exists(songdir):
-            rmtree(songdir)
-        os.mkdir(songdir)
-        with open(infopath, 'w') as fr:
-            fr.write(json.dumps(self.metadata_json()))
-            fr.close()
-        with open(datapath, 'w') as fr:
-            fr.write(json.dumps(self.level_json()))
-            fr.close()
-        self.audio.export(f'{songdir}/ai_{self.name}.ogg', format='ogg')
-
-    def level_json(self):
+        return (time - self.offset * 1000) / beat_time
+
+    def export(self, outdir='./output', audio_cache=None):
+        # Files whose content did not change are left alone, and encoded
+        # audio comes from the cache when the source was seen before.
+        songdir = f'{outdir}/ai_{self.name}'
+        os.makedirs(songdir, exist_ok=True)
+        oggname = f'ai_{self.name}.{AUDIO_FORMAT}'
+        files = {'info.dat', oggname}
+
+        # The analysis runs first, on its own, so its stages are measured
+        # without the encoder; encoding then overlaps the serialization.
+        self.charts
+        with ThreadPoolExecutor(1) as pool:
+            encoding = pool.submit(
+                self._export_audio, f'{songdir}/{oggname}', audio_cache
+            )
+            with self.stats.stage('json'):
+                for filename, write in self.map_files():
+                    files.add(filename)
+                    write_if_changed(f'{songdir}/{filename}', write)
+            encoding.result()
+
+        # Leftovers of earlier exports, e.g. difficulties no longer made.
+        for name in os.listdir(songdir):
+            path = f'{songdir}/{name}'
+            if name not in files and os.path.isfile(path):
+                os.remove(path)
+
+    def _export_audio(self, path, audio_cache):
+        with self.stats.stage('encode'):
+            if audio_cache is None:
+                self._encode(path)
+                return
+            try:
+                link(self._cached_audio(audio_cache), path)
+            except FileNotFoundError:
+                # Evicted by another process in the meantime.
+                self._encode(path)
+
+    def package(self, archive, folder='', audio_cache=None):
+        # Writes the map straight into an open ZipFile, under `folder` when
+        # several songs share the archive. The audio is stored as is since
+        # it is compressed already. As in export(), the analysis is done
+        # before encoding starts.
+        self.charts
+        with ThreadPoolExecutor(1) as pool:
+            encoding = pool.submit(self._packaged_audio, audio_cache)
+            with self.stats.stage('json'):
+                for filename, write in self.map_files():
+                    entry = ZipInfo(
+                        f'{folder}{filename}', time.localtime()[:6]
+                    )
+                    entry.compress_type = ZIP_DEFLATED
+                    with archive.open(entry, 'w') as fr:
+                        write(fr)
+            audio = encoding.result()
+        with self.stats.stage('zip'):
+            oggname = f'{folder}ai_{self.name}.{AUDIO_FORMAT}'
+            if audio_cache is None:
+                archive.writestr(oggname, audio, compress_type=ZIP_STORED)
+            else:
+                archive.write(audio, oggname, compress_type=ZIP_STORED)
+
+    def _packaged_audio(self, audio_cache):
+        # The cached file's path, or the encoded bytes without a cache.
+        with self.stats.stage('encode'):
+            if audio_cache is not None:
+                return self._cached_audio(audio_cache)
+            if self.audio is None:
+                return transcode_bytes(self.source, AUDIO_FORMAT)
+            encoded = io.BytesIO()
+            self.audio.export(encoded, format=AUDIO_FORMAT)
+            return encoded.getvalue()
+
+    def _cached_audio(self, audio_cache):
+        key = self.audio_key()
+        cached = audio_cache.get(key)
+        if cached is None:
+            cached = audio_cache.put(key, self._encode)
+        return cached
+
+    def _encode(self, path):
+        if self.audio is None:
+            transcode(self.source, path, AUDIO_FORMAT)
+        else:
+            self.audio.export(path, format=AUDIO_FORMAT).close()
+
+    def audio_key(self):
+        if self.audio is None:
+            return file_hash(self.source, AUDIO_FORMAT)
+        return audio_hash(self.audio, AUDIO_FORMAT)
+
+    def map_files(self):
+        # (filename, write) for each JSON file of the map, where `write`
+        # streams it to a binary file.
+        files = [(
+            'info.dat',
+            lambda fr: write_json(fr, self.metadata_json(), self.compat)
+        )]
+        for name in self.difficulties:
+            files.append((
+                difficulties[name].filename,
+                lambda fr, name=name: write_level(
+                    fr, self.charts[name], self.compat, self.precision
+                )
+            ))
+        return files
+
+    def level_json(self, difficulty=None):
+        chart = self.charts[difficulty] if difficulty else self.chart
         return {
             '_events': [], # Cool light stuff goes here but is not a priority.
-            '_notes': [note.json() for note in self.chart],
+            '_notes': chart.json(),
             '_obstacles': [] # We won't worry about walls for now.
         }
 
@@ -150,97 +479,358 @@ class Song:
             '_shufflePeriod': 0.5, # WTF is this?
             '_previewStartTime': 0,
             '_previewDuration': 15,
-            '_songFilename': f'ai_{self.name}.ogg',
+            '_songFilename': f'ai_{self.name}.{AUDIO_FORMAT}',
             '_environmentNane': 'BigMirrorEnvironment',
-            '_songTimeOffset': 0,
+            '_songTimeOffset': self.offset,
             '_difficultyBeatmapSets': [
                 {
                     '_beatmapCharacteristicName': 'Standard',
                     '_difficultyBeatmaps': [
                         {
-                            '_difficulty': 'Expert',
-                            '_difficultyRank': 7,
-                            '_beatmapFilename': 'Expert.dat',
-                            '_noteJumpMovementSpeed': 12,
+                            '_difficulty': difficulty.name,
+                            '_difficultyRank': difficulty.rank,
+                            '_beatmapFilename': difficulty.filename,
+                            '_noteJumpMovementSpeed': difficulty.speed,
                             '_noteJumpStartBeatOffset': 0
                         }
+                        for difficulty in (
+                            difficulties[name] for name in self.difficulties
+                        )
                     ]
                 }
             ]
         }   
 
     def _calculate_bpm(self):
-        changes = sorted(change([peak.time for peak in self.peaks]))
-        median = changes[len(changes) // 2]
-        bpm = (60 * 1000) / median
-        # A wacky BPM calculate shouldn't really matter to us, I think...
-        if bpm > 200:
-            return 200
-        if bpm < 50:
-            return 50
-        return bpm
+        return calculate_bpm([peak.time for peak in self.peaks])
+
+
+class ChartBuilder:
+    # create_level over peaks that arrive in order. The pattern matcher
+    # looks at most max_pattern_length peaks ahead, so a peak is charted
+    # once that many kept peaks follow it, or at finish(), and the chart is
+    # the same as from the whole list at once.
+    def __init__(self, difficulty, bpm, offset=0, stats=None, seed=1):
+        self.difficulty = difficulty
+        self.bpm = bpm
+        self.offset = offset
+        self.stats = stats or Stats()
+        # A private generator keeps charts reproducible when songs are
+        # generated side by side.
+        self.rng = random.Random(seed)
+        self.chart = Chart()
+        # Kept peaks that are not charted yet, and how many were before.
+        self.peaks = []
+        self.charted = 0
+        self.last_kept = None
+        self.last_note = None
+
+    def adjusted_time(self, time):
+        beat_time = (1 / self.bpm) * 60 * 1000
+        return (time - self.offset * 1000) / beat_time
+
+    def push(self, peaks):
+        # Returns how many notes became final.
+        spacing = self.difficulty.spacing
+        for peak in peaks:
+            # Drops peaks closer than `spacing` beats to the previous kept
+            # one.
+            if spacing and self.last_kept is not None and \
+                    peak.time - self.last_kept.time < \
+                    spacing * 60 * 1000 / self.bpm:
+                continue
+            self.peaks.append(peak)
+            self.last_kept = peak
+        return self._advance(False)
+
+    def finish(self):
+        return self._advance(True)
+
+    def _advance(self, final):
+        before = len(self.chart)
+        i = 0
+        while i < len(self.peaks) and \
+                (final or i + max_pattern_length < len(self.peaks)):
+            i += self._step(i)
+        del self.peaks[:i]
+        self.charted += i
+        return len(self.chart) - before
+
+    def _step(self, i):
+        # Charts the peak at i, and those after it when a pattern matched.
+        # Returns how many peaks it used.
+        peaks = self.peaks
+        difficulty = self.difficulty
+        turns = difficulty.turns
+        rng = self.rng
+        level = self.chart
+        last_note = self.last_note
+        used = 0
+        options = []
+        nxt = []
+        peak = peaks[i]
+
+        # Try to find pattern.
+        for length in range(1, max_pattern_length + 1):
+            # Make sure we don't go out of bounds.
+            if i + length >= len(peaks):
+                continue
+
+            times = [p.time for p in peaks[i:i+length]]
+            ranges = tuple(accumulate(
+                [0.0] + [get_range(t) for t in change(times)]
+            ))
+
+            # Patterns whose intervals match.
+            matches = difficulty.pattern_index.get((length, ranges), [])
+            for match in matches:
+                # Make sure we don't change directions abruptly
+                first = match.notes[0][0]
+                if last_note and not first.direction in \
+                    directions[last_note.direction][:turns]:
+                    continue
 
+                options.append(match.notes)
+
+        # Prefer patterns starting with the hand of the onset's band.
+        band = BANDS.get(peak.band)
+        if band and band.note_type is not None:
+            options = [
+                o for o in options if o[0][0].type == band.note_type
+            ] or options
+
+        # Do we have options
+        if options:
+            self.stats.count('pattern_hits')
+            choice = rng.choice(options)
+            for c in range(len(choice)):
+                for note in choice[c]:
+                    nxt.append((
+                        note.type,
+                        self.adjusted_time(peaks[i+c].time),
+                        note.row, note.col,
+                        note.direction
+                    ))
+            used = len(choice)
+
+        if not nxt:
+            # Resort to randomness if we can't find a matching pattern.
+            self.stats.count('random_fallbacks')
+            row = rng.randint(0, 2)
+            time = self.adjusted_time(peak.time)
+            note_type = rng.choice([NoteType.blue, NoteType.red])
+            direction = CutDirection(rng.randint(0, 7))
+            col = rng.randint(0, 1)
+            if note_type == NoteType.blue:
+                col = rng.randint(2, 3)
+            if band and band.note_type is not None:
+                # Same draws as without bands, then moved to the band's
+                # hand and row.
+                if band.note_type != note_type:
+                    col = 3 - col
+                note_type, row = band.note_type, band.row
+
+            if self.charted + i - 1 >= 0:
+                last_note = level[-1]
+                direction = rng.choice(
+                    directions[last_note.direction][:turns]
+                )
+
+            nxt = [(note_type, time, row, col, direction)]
+            used = 1
+
+        for note in nxt:
+            level.append(*note)
+        self.last_note = level[-1]
+        return used
+
+
+class LiveSong:
+    # Charts PCM while it is still arriving, from a pipe or an audio
+    # device, for one difficulty. Peaks come from StreamAnalyzer and notes
+    # from a ChartBuilder. The tempo is only known at the end of a track,
+    # so the BPM is given; with the one Song settles on, the chart is the
+    # same as Song's.
+    parameters = ('cutoff', 'polling_interval', 'leniency', 'spacing', 'seed')
+    cutoff = CUTOFF
+    polling_interval = POLLING_INTERVAL
+    leniency = LENIENCY
+    spacing = SPACING
+    seed = 1
+
+    def __init__(self, frame_rate, channels, sample_width, bpm,
+                 difficulty='Expert', stats=None, **params):
+        for param, value in params.items():
+            if param not in self.parameters:
+                raise TypeError(f'Unknown parameter {param}')
+            setattr(self, param, value)
+        self.frame_rate = frame_rate
+        self.stats = stats or Stats()
+        self.analyzer = StreamAnalyzer(
+            frame_rate, channels, sample_width, self.cutoff,
+            self.polling_interval, self.leniency, PEAK_CRITERIA, self.spacing,
+            LOUDNESS_WINDOW
+        )
+        self.builder = ChartBuilder(
+            difficulties[difficulty], bpm, stats=self.stats, seed=self.seed
+        )
+        # Per block: frames fed, seconds spent on it, notes it made final,
+        # and how far the oldest of them lay behind the audio fed, in ms.
+        self.blocks = []
+
+    @property
+    def chart(self):
+        return self.builder.chart
+
+    def feed(self, block):
+        # Returns the notes that became final.
+        start = time.perf_counter()
+        with self.stats.stage('live'):
+            found = self.analyzer.feed(block)
+            count = self.builder.push(
+                [Segment(time, amplitude) for time, amplitude in found]
+            )
+        return self._final(start, len(block), count)
+
+    def finish(self):
+        start = time.perf_counter()
+        with self.stats.stage('live'):
+            found = self.analyzer.finish()
+            self.builder.push(
+                [Segment(time, amplitude) for time, amplitude in found]
+            )
+            count = self.builder.finish()
+        return self._final(start, 0, count)
+
+    def _final(self, start, frames, count):
+        chart = self.chart
+        notes = [chart[i] for i in range(len(chart) - count, len(chart))]
+        fed = self.analyzer.frames / self.frame_rate * 1000
+        self.blocks.append({
+            'frames': frames,
+            'seconds': time.perf_counter() - start,
+            'notes': count,
+            'delay': fed - notes[0].time * 60 * 1000 / self.builder.bpm
+            if notes else None
+        })
+        self.stats.count('notes', count)
+        return notes
+
+    def latency(self):
+        # Summary of the per-block metrics.
+        seconds = [b['seconds'] for b in self.blocks]
+        delays = [b['delay'] for b in self.blocks if b['delay'] is not None]
+        fed = sum(b['frames'] for b in self.blocks) / self.frame_rate
+        return {
+            'blocks': len(self.blocks),
+            'block_mean': float(np.mean(seconds)) if seconds else 0.0,
+            'block_max': max(seconds, default=0.0),
+            'realtime': fed / sum(seconds) if sum(seconds) else None,
+            'delay_p50': float(np.percentile(delays, 50)) if delays else None,
+            'delay_max': max(delays, default=None)
+        }
 
-def segments(audio, interval):
-    intervals = chunks(audio, interval)
-    offset = interval / 2
-    return [
-        Segment((i * interval) + offset, abs(intervals[i].dBFS))
-        for i in range(len(intervals))
-    ]
 
+def generate_chart(peaks, bpm, difficulty, seed=1, offset=0, stats=None):
+    # The chart of `difficulty` for `peaks`. Nothing is shared between
+    # calls but the read-only pattern tables, so any number can run at once
+    # in threads and the same arguments always give the same chart.
+    builder = ChartBuilder(difficulty, bpm, offset, stats, seed)
+    builder.push(peaks)
+    builder.finish()
+    return builder.chart
 
-def peaks(audio, segments):
-    result = []
-    last_peak = 0
-    for i in range(1, len(segments)-1):
-        cur, prv, nxt = segments[i], segments[i-1], segments[i+1]
-        delta = cur.time - last_peak
-        left = [s for s in segments[i-LENIENCY:i]]
-        right = [s for s in segments[i+1:i+LENIENCY+1]]
-        sides = left + right
 
-        # Check if segment louder than all adjacent segments. 
-        if not all(sides, lambda s: cur.amplitude > s.amplitude):
-            continue
+def generate_charts(songs, workers=None):
+    # Song.charts for many songs from a thread pool. Decoding, filtering
+    # and the envelope run in NumPy, which releases the GIL, so one song's
+    # analysis overlaps another's chart pass. Returns them in order.
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(lambda song: song.charts, songs))
 
-        # Check if there is distinction between current segment and adjacent
-        # segments.
-        distinct = lambda s: s.amplitude < cur.amplitude * 0.75
-        if not (count(left, distinct) >= 1 and count(right, distinct) >= 1):
-            continue 
 
-        # Check if all near segments are above loudness threshold for the frame.
-        loudness = abs(audio[cur.time-3000:cur.time+5000].dBFS)       
-        if not all(sides, lambda s: s.amplitude > loudness * 0.5):
-            continue
-        
-        # Sanity check for placing notes too close to each other.
-        if not delta >= 10:
-            continue
+def pick_bpm(tempo, times):
+    # The tempo estimate when it is confident, else the median interval
+    # between the peak `times`.
+    bpm, confidence, _ = tempo
+    if bpm is not None and confidence >= MIN_CONFIDENCE:
+        return bpm
+    return calculate_bpm(times)
 
-        result.append(cur)
-        last_peak = cur.time
 
-    # TODO: Weave merge close notes.
-    return result
+def calculate_bpm(times):
+    changes = sorted(change(times))
+    median = changes[len(changes) // 2]
+    bpm = (60 * 1000) / median
+    # A wacky BPM calculate shouldn't really matter to us, I think...
+    if bpm > 200:
+        return 200
+    if bpm < 50:
+        return 50
+    return bpm
+
 
+def segments(audio, interval, index=None):
+    if index is None:
+        index = LoudnessIndex(as_samples(audio))
+    times, amplitudes = index.envelope(interval)
+    return [
+        Segment(time, amplitude)
+        for time, amplitude in zip(times.tolist(), amplitudes.tolist())
+    ]
 
-def chunks(arr, size):
-    return [arr[x:x+size] for x in range(0, len(arr), size)]
 
+def peaks(audio, segments, criteria=PEAK_CRITERIA, leniency=LENIENCY,
+          spacing=SPACING, index=None):
+    if index is None:
+        index = LoudnessIndex(as_samples(audio))
+    times = np.array([s.time for s in segments], dtype=np.float64)
+    amplitudes = np.array([s.amplitude for s in segments], dtype=np.float64)
+    before, after = LOUDNESS_WINDOW
+    loudness = np.abs(index.dbfs(times - before, times + after))
 
-def change(arr):
-    return [arr[i] - arr[i-1] for i in range(1, len(arr))]
+    # TODO: Weave merge close notes.
+    return [
+        segments[i] for i in detect_peaks(
+            times, amplitudes, loudness, leniency, criteria, spacing
+        )
+    ]
 
 
-def all(arr, predicate):
-    for x in arr:
-        if not predicate(x):
-            return False
+def write_if_changed(path, write):
+    # `write` streams the content to a binary file, which only replaces
+    # `path` when the content differs.
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as fr:
+        write(fr)
+    if os.path.exists(path) and filecmp.cmp(tmp, path, shallow=False):
+        os.remove(tmp)
+        return False
+    os.replace(tmp, path)
     return True
 
 
+def merge_onsets(peaks, onsets, gap=ONSET_GAP):
+    # Adds band onsets to the loudness peaks, skipping those within `gap`
+    # ms of a peak or of an onset kept before.
+    found = sorted(peaks + onsets, key=lambda p: (p.time, p.band is not None))
+    kept = []
+    for peak in found:
+        if peak.band is not None and kept and \
+                peak.time - kept[-1].time < gap:
+            continue
+        if peak.band is None and kept and kept[-1].band is not None and \
+                peak.time - kept[-1].time < gap:
+            # A loudness peak wins over an onset just before it.
+            kept.pop()
+        kept.append(peak)
+    return kept
+
+
+def change(arr):
+    return [arr[i] - arr[i-1] for i in range(1, len(arr))]
+
+
 def in_range(value, range):
     return range[0] <= value < range[1]
 
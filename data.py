@@ -1,4 +1,6 @@
+from array import array
 from enum import Enum
+from functools import cached_property
 
 
 class NoteType(Enum):
@@ -48,6 +50,94 @@ class Note:
         return s
 
 
+class Chart:
+    # Notes stored column by column in typed arrays rather than as one
+    # object per note. Indexing returns a lightweight NoteView.
+    def __init__(self):
+        self.times = array('d')
+        self.rows = array('b')
+        self.columns = array('b')
+        self.types = array('b')
+        self.directions = array('b')
+
+    def append(self, note_type, time, row, column, direction):
+        self.times.append(time)
+        self.rows.append(row)
+        self.columns.append(column)
+        self.types.append(int(note_type))
+        self.directions.append(int(direction))
+
+    def json(self):
+        return [
+            {
+                '_time': time,
+                '_lineIndex': column,
+                '_lineLayer': row,
+                '_type': note_type,
+                '_cutDirection': direction
+            }
+            for time, column, row, note_type, direction in zip(
+                self.times, self.columns, self.rows, self.types,
+                self.directions
+            )
+        ]
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('chart index out of range')
+        return NoteView(self, i)
+
+    def __iter__(self):
+        return (NoteView(self, i) for i in range(len(self)))
+
+
+class NoteView:
+    __slots__ = ('chart', 'index')
+
+    def __init__(self, chart, index):
+        self.chart = chart
+        self.index = index
+
+    @property
+    def type(self):
+        return NoteType(self.chart.types[self.index])
+
+    @property
+    def time(self):
+        return self.chart.times[self.index]
+
+    @property
+    def row(self):
+        return self.chart.rows[self.index]
+
+    @property
+    def column(self):
+        return self.chart.columns[self.index]
+
+    @property
+    def direction(self):
+        return CutDirection(self.chart.directions[self.index])
+
+    def json(self):
+        return {
+            '_time': self.time,
+            '_lineIndex': self.column,
+            '_lineLayer': self.row,
+            '_type': int(self.type),
+            '_cutDirection': int(self.direction)
+        }
+
+    def __repr__(self):
+        s = f'[time={self.time}, type={int(self.type)}, '
+        s += f'pos=({self.row}, {self.column})]'
+        return s
+
+
 # [Easy, Medium, Medium, Hard, Hard]
 directions = {
     CutDirection.up: [
@@ -154,6 +244,31 @@ class Pattern:
         self.notes = notes
 
 
+class Difficulty:
+    def __init__(self, name, rank, spacing, turns, pattern_types, speed):
+        self.name = name
+        self.rank = rank
+        # Minimum time between consecutive notes, in beats.
+        self.spacing = spacing
+        # How many of the `directions` choices, easiest first, may follow a
+        # cut.
+        self.turns = turns
+        self.pattern_types = pattern_types
+        # Note jump movement speed.
+        self.speed = speed
+
+    @property
+    def filename(self):
+        return f'{self.name}.dat'
+
+    @cached_property
+    def pattern_index(self):
+        # Built on first use, once per difficulty rather than per chart.
+        return index_patterns({
+            t: p for t, p in patterns.items() if t in self.pattern_types
+        })
+
+
 patterns = {
     PatternType.dance: Pattern(
         [[0.0, 1.0], [0.0, 0.5]], 
@@ -473,4 +588,49 @@ patterns = {
             ]
         ]
     )
-}
\ No newline at end of file
+}
+
+def index_patterns(patterns):
+    # Patterns keyed by timing, so the candidates for a run of peaks are a
+    # single lookup. Each list keeps the order of `patterns`.
+    index = {}
+    for pattern in patterns.values():
+        length = len(pattern.timings[0])
+        for timing in pattern.timings:
+            matching = index.setdefault((length, tuple(timing)), [])
+            if pattern not in matching:
+                matching.append(pattern)
+    return index
+
+
+# Longest run of peaks create_level tries to match, worked out once.
+max_pattern_length = max(len(p.timings) for p in patterns.values())
+
+
+easy_patterns = [
+    PatternType.dance,
+    PatternType.tap_red,
+    PatternType.tap_blue,
+    PatternType.handle_right,
+    PatternType.handle_left,
+    PatternType.hop_wide_right,
+    PatternType.hop_wide_left,
+    PatternType.hop_narrow_right,
+    PatternType.hop_narrow_left
+]
+
+normal_patterns = easy_patterns + [
+    PatternType.cross,
+    PatternType.sides,
+    PatternType.scoop_right,
+    PatternType.scoop_left,
+    PatternType.wave_right
+]
+
+difficulties = {
+    'Easy': Difficulty('Easy', 1, 1.0, 1, easy_patterns, 10),
+    'Normal': Difficulty('Normal', 3, 0.5, 3, normal_patterns, 10),
+    'Hard': Difficulty('Hard', 5, 0.25, 5, list(patterns), 12),
+    'Expert': Difficulty('Expert', 7, 0.0, 5, list(patterns), 12),
+    'ExpertPlus': Difficulty('ExpertPlus', 9, 0.0, 5, list(patterns), 16)
+}
@@ -0,0 +1,149 @@
+import wave
+import subprocess
+import numpy as np
+from pydub import AudioSegment
+from pydub.utils import mediainfo
+from dsp import as_samples
+from cache import source_key
+
+
+BLOCK_SECONDS = 1.0
+
+# ffmpeg names of the raw PCM layouts, by sample width.
+PCM_FORMATS = {1: 's8', 2: 's16le', 4: 's32le'}
+
+
+def read_pcm(filename, seconds=BLOCK_SECONDS):
+    # Decodes to 16-bit PCM like AudioSegment.from_file does for compressed
+    # formats, but hands it over in blocks of (frames, channels) arrays
+    # instead of holding the whole track.
+    info = mediainfo(filename)
+    frame_rate, channels = int(info['sample_rate']), int(info['channels'])
+    return frame_rate, channels, 2, _blocks(
+        filename, channels, int(frame_rate * seconds)
+    )
+
+
+def _blocks(filename, channels, frames):
+    command = [
+        AudioSegment.converter, '-v', 'error', '-i', filename, '-vn',
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-'
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    size = frames * channels * 2
+    completed = False
+    try:
+        pending = b''
+        while True:
+            data = process.stdout.read(size)
+            if not data:
+                break
+            data = pending + data
+            whole = len(data) - len(data) % (channels * 2)
+            pending = data[whole:]
+            if whole:
+                yield np.frombuffer(data[:whole], dtype=np.int16) \
+                    .reshape(-1, channels)
+        completed = True
+    finally:
+        process.stdout.close()
+        if not completed:
+            process.kill()
+        process.wait()
+    if process.returncode:
+        raise RuntimeError(f'Decoding {filename} failed')
+
+
+def decode_cached(filename, cache):
+    # AudioSegment.from_file through a cache.PCMCache. A hit decodes
+    # nothing; the segment gets its own copy of the mapped samples, so it
+    # is an ordinary AudioSegment in every respect.
+    key = source_key(filename)
+    samples = cache.get(key, filename)
+    if samples is None:
+        audio = AudioSegment.from_file(filename)
+        cache.put(key, filename, as_samples(audio))
+        return audio
+    return AudioSegment(
+        data=samples.data.tobytes(), sample_width=samples.sample_width,
+        frame_rate=samples.frame_rate, channels=samples.channels
+    )
+
+
+def decode_samples(filename, cache):
+    # Like decode_cached, for analysis only: a hit returns read-only views
+    # of the mapped entry without copying them.
+    key = source_key(filename)
+    samples = cache.get(key, filename)
+    if samples is None:
+        samples = as_samples(AudioSegment.from_file(filename))
+        cache.put(key, filename, samples)
+    return samples
+
+
+def audio_blocks(audio, seconds=BLOCK_SECONDS):
+    # Views over an AudioSegment that is already in memory.
+    data = as_samples(audio).data
+    frames = max(1, int(audio.frame_rate * seconds))
+    for i in range(0, len(data), frames):
+        yield data[i:i+frames]
+
+
+def transcode(filename, destination, format='ogg'):
+    subprocess.run(
+        [
+            AudioSegment.converter, '-v', 'error', '-y', '-i', filename,
+            '-vn', '-f', format, destination
+        ],
+        check=True
+    )
+
+
+def transcode_bytes(filename, format='ogg'):
+    return subprocess.run(
+        [
+            AudioSegment.converter, '-v', 'error', '-i', filename, '-vn',
+            '-f', format, '-'
+        ],
+        check=True, stdout=subprocess.PIPE
+    ).stdout
+
+
+def write_wav(blocks, destination, frame_rate, channels, sample_width):
+    # Writes (frames, channels) blocks to a WAV file as they come.
+    with wave.open(destination, 'wb') as fr:
+        fr.setnchannels(channels)
+        fr.setsampwidth(sample_width)
+        fr.setframerate(frame_rate)
+        for block in blocks:
+            if sample_width == 1:
+                # 8-bit WAV is unsigned.
+                block = (block.astype(np.int16) + 128).astype(np.uint8)
+            fr.writeframes(block.tobytes())
+
+
+def encode_pcm(blocks, destination, frame_rate, channels, sample_width,
+               format='ogg'):
+    # Pipes (frames, channels) blocks into the encoder as they come, so the
+    # audio is never whole in memory.
+    command = [
+        AudioSegment.converter, '-v', 'error', '-y',
+        '-f', PCM_FORMATS[sample_width], '-ar', str(frame_rate),
+        '-ac', str(channels), '-i', '-', '-f', format, destination
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    completed = False
+    try:
+        for block in blocks:
+            process.stdin.write(block.tobytes())
+        completed = True
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            completed = False
+        if not completed:
+            process.kill()
+        process.wait()
+    if process.returncode:
+        raise RuntimeError(f'Encoding {destination} failed')
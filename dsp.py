@@ -0,0 +1,506 @@
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+class Samples:
+    def __init__(self, data, frame_rate, sample_width):
+        # (frames, channels) array of integer samples.
+        self.data = data
+        self.frame_rate = frame_rate
+        self.sample_width = sample_width
+
+    @classmethod
+    def from_audio(cls, audio):
+        data = np.frombuffer(audio.raw_data, dtype=DTYPES[audio.sample_width])
+        return cls(
+            data.reshape(-1, audio.channels),
+            audio.frame_rate, audio.sample_width
+        )
+
+    @property
+    def channels(self):
+        return self.data.shape[1]
+
+    @property
+    def max_possible_amplitude(self):
+        return (2 ** (self.sample_width * 8)) / 2
+
+    def frame_count(self, ms):
+        # Same millisecond to frame conversion as AudioSegment slicing.
+        return (ms * (self.frame_rate / 1000.0)).astype(np.int64)
+
+    def __len__(self):
+        return round(1000 * (len(self.data) / self.frame_rate))
+
+
+class LowPass:
+    # The first-order RC filter of AudioSegment.low_pass_filter, evaluated
+    # block-recursively over arrays. The state carries across process()
+    # calls, so a track can be fed whole or in blocks.
+    def __init__(self, cutoff, frame_rate):
+        rc = 1.0 / (cutoff * 2 * math.pi)
+        dt = 1.0 / frame_rate
+        self.alpha = dt / (rc + dt)
+        self.state = None
+
+    def process(self, block):
+        x = np.asarray(block, dtype=np.float64)
+        result = np.empty_like(x)
+        if not len(x):
+            return result
+        start = 0
+        if self.state is None:
+            # pydub seeds the filter with the first frame.
+            self.state = result[0] = x[0]
+            start = 1
+        for channel in range(x.shape[1]):
+            result[start:, channel] = _first_order(
+                self.alpha * x[start:, channel], 1 - self.alpha,
+                self.state[channel]
+            )
+        self.state = result[-1].copy()
+        return result
+
+
+BLOCK = 64
+
+
+def _first_order(x, c, y0):
+    # y[i] = c * y[i-1] + x[i] with y[-1] = y0. Each block's zero-state
+    # response is one matrix product; the block end states are the same
+    # recursion with coefficient c ** BLOCK, solved the same way.
+    n = len(x)
+    if not n:
+        return x
+    powers = c ** np.arange(1, BLOCK + 1)
+    steps = np.arange(BLOCK)
+    lags = steps[None, :] - steps[:, None]
+    response = np.where(lags >= 0, c ** np.maximum(lags, 0), 0.0)
+
+    blocks = -(-n // BLOCK)
+    padded = np.zeros(blocks * BLOCK)
+    padded[:n] = x
+    zero_state = padded.reshape(blocks, BLOCK) @ response
+    if blocks == 1:
+        ends = zero_state[:, -1] + powers[-1] * y0
+    else:
+        ends = _first_order(zero_state[:, -1], powers[-1], y0)
+    starts = np.concatenate([[y0], ends[:-1]])
+    y = zero_state + starts[:, None] * powers[None, :]
+    return y.ravel()[:n]
+
+
+def low_pass(samples, cutoff, mono=False, decimate=1):
+    # Optionally downmix and average down by `decimate` first; a low band
+    # needs far fewer samples and the averaging doubles as anti-aliasing.
+    data = samples.data.astype(np.float64)
+    frame_rate = samples.frame_rate
+    if mono:
+        mixed = data[:, :1].copy()
+        for channel in range(1, samples.channels):
+            mixed += data[:, channel:channel + 1]
+        data = mixed / samples.channels
+    if decimate > 1:
+        frames = len(data) // decimate
+        data = data[:frames * decimate].reshape(
+            frames, decimate, data.shape[1]
+        ).mean(axis=1)
+        frame_rate = frame_rate / decimate
+
+    filtered = LowPass(cutoff, frame_rate).process(data)
+    # pydub truncates every output sample to the sample type.
+    filtered = np.trunc(filtered).astype(samples.data.dtype)
+    return Samples(filtered, frame_rate, samples.sample_width)
+
+
+def as_samples(audio):
+    if isinstance(audio, Samples):
+        return audio
+    return Samples.from_audio(audio)
+
+
+def energy_index(samples):
+    # Cumulative sum of squared samples per frame, so the energy of any frame
+    # range is a single subtraction. Integer sums are exact for 8/16-bit audio.
+    dtype = np.int64 if samples.sample_width <= 2 else np.float64
+    # Summing channel columns is much faster than a sum over axis 1.
+    energy = np.square(samples.data[:, 0], dtype=dtype)
+    for channel in range(1, samples.channels):
+        energy += np.square(samples.data[:, channel], dtype=dtype)
+    index = np.empty(len(energy) + 1, dtype=dtype)
+    index[0] = 0
+    np.cumsum(energy, out=index[1:])
+    return index
+
+
+def dbfs(energy, count, max_possible_amplitude):
+    # Vectorized AudioSegment.dBFS: audioop.rms truncates to an integer.
+    energy, count = np.asarray(energy), np.asarray(count)
+    mean = np.divide(
+        energy, count, out=np.zeros(energy.shape), where=count > 0
+    )
+    rms = np.floor(np.sqrt(mean))
+
+    # There are few distinct rms values, so convert each once with the same
+    # float path as pydub.utils.ratio_to_db to get bit-identical results.
+    values, inverse = np.unique(rms, return_inverse=True)
+    db = np.array([
+        20 * math.log(v / max_possible_amplitude, 10) if v else -math.inf
+        for v in values.tolist()
+    ])
+    return db[inverse].reshape(rms.shape)
+
+
+def envelope(samples, interval):
+    return LoudnessIndex(samples).envelope(interval)
+
+
+class LoudnessIndex:
+    def __init__(self, samples, index=None, offset=0):
+        # index[i] is the energy of every frame before offset + i, so a
+        # stream can drop the head of the index it no longer needs.
+        self.samples = samples
+        self.index = energy_index(samples) if index is None else index
+        self.offset = offset
+
+    @property
+    def dBFS(self):
+        count = len(self.samples.data) * self.samples.channels
+        return float(dbfs(
+            self.index[-1], count, self.samples.max_possible_amplitude
+        ))
+
+    def energy(self, first, last):
+        # Energy of the [first, last) frame ranges, which must not start
+        # before the offset.
+        top = len(self.index) - 1
+        first = np.clip(first - self.offset, 0, top)
+        last = np.clip(last - self.offset, 0, top)
+        return self.index[last] - self.index[first]
+
+    def envelope(self, interval, start=0):
+        # Per-interval dBFS magnitude from `start` ms to the end, chunked
+        # like AudioSegment slicing.
+        length = len(self.samples)
+        starts = np.arange(start, length, interval)
+        ends = np.minimum(starts + interval, length)
+        first = self.samples.frame_count(starts)
+        last = self.samples.frame_count(ends)
+
+        # Frames past the end of the data count as silence, like AudioSegment
+        # slicing pads them.
+        frames = len(self.samples.data)
+        energy = self.energy(
+            np.minimum(first, frames), np.minimum(last, frames)
+        )
+        count = (last - first) * self.samples.channels
+        db = dbfs(energy, count, self.samples.max_possible_amplitude)
+        return starts + (interval / 2), np.abs(db)
+
+    def dbfs(self, start, end):
+        # dBFS of the [start, end) millisecond window in O(1), with the same
+        # clamping, wrapping and padding as AudioSegment slicing.
+        length = len(self.samples)
+        start = np.minimum(np.asarray(start, dtype=np.float64), length)
+        end = np.minimum(np.asarray(end, dtype=np.float64), length)
+        start = np.where(start < 0, length - np.abs(start), start)
+        end = np.where(end < 0, length - np.abs(end), end)
+        start = self.samples.frame_count(start)
+        end = self.samples.frame_count(end)
+
+        frames = len(self.samples.data)
+        first, last = _clip_index(start, frames), _clip_index(end, frames)
+        present = np.maximum(last - first, 0)
+        count = np.maximum(end - start, present) * self.samples.channels
+        energy = np.where(last > first, self.energy(first, last), 0)
+        return dbfs(energy, count, self.samples.max_possible_amplitude)
+
+
+def _clip_index(i, length):
+    # Python slice semantics for a single index.
+    i = np.where(i < 0, i + length, i)
+    return np.clip(i, 0, length)
+
+
+class Neighbours:
+    def __init__(self, amplitudes, loudness, leniency):
+        # Max/min over the LENIENCY frames either side of every frame. The
+        # left window of the first frames is empty, as the negative slice in
+        # the original per-segment loop was; the right one is cut at the end.
+        self.amplitudes = amplitudes
+        self.loudness = loudness
+        self.left_max = _window(amplitudes, leniency, -np.inf, np.max, True)
+        self.left_min = _window(amplitudes, leniency, np.inf, np.min, True)
+        self.right_max = _window(amplitudes, leniency, -np.inf, np.max, False)
+        self.right_min = _window(amplitudes, leniency, np.inf, np.min, False)
+
+    @property
+    def sides_max(self):
+        return np.maximum(self.left_max, self.right_max)
+
+    @property
+    def sides_min(self):
+        return np.minimum(self.left_min, self.right_min)
+
+
+def _window(arr, size, fill, reduce, left):
+    if left:
+        result = np.full(len(arr), fill)
+        if len(arr) > size:
+            windows = sliding_window_view(arr, size)[:-1]
+            result[size:] = reduce(windows, axis=1)
+        return result
+    padded = np.concatenate([arr[1:], np.full(size, fill)])
+    return reduce(sliding_window_view(padded, size)[:len(arr)], axis=1)
+
+
+def louder_than_neighbours(n):
+    return n.amplitudes > n.sides_max
+
+
+def distinct_from_neighbours(ratio):
+    def criterion(n):
+        threshold = n.amplitudes * ratio
+        return (n.left_min < threshold) & (n.right_min < threshold)
+    return criterion
+
+
+def above_loudness(ratio):
+    def criterion(n):
+        return n.sides_min > n.loudness * ratio
+    return criterion
+
+
+def detect_peaks(times, amplitudes, loudness, leniency, criteria, spacing):
+    neighbours = Neighbours(amplitudes, loudness, leniency)
+    mask = np.zeros(len(amplitudes), dtype=bool)
+    mask[1:-1] = True
+    for criterion in criteria:
+        mask &= criterion(neighbours)
+    return space_peaks(times, mask, spacing)
+
+
+def space_peaks(times, mask, spacing):
+    # Spacing depends on the last accepted peak, so it is one linear pass
+    # over the surviving candidates.
+    result = []
+    last_peak = 0
+    for i in np.flatnonzero(mask).tolist():
+        if times[i] - last_peak >= spacing:
+            result.append(i)
+            last_peak = times[i]
+    return result
+
+
+class StreamAnalyzer:
+    # Low-pass, envelope and peak detection over PCM fed in blocks. Only
+    # the loudness window and LENIENCY frames of context stay in memory, and
+    # the peaks match detect_peaks over the whole track.
+    def __init__(self, frame_rate, channels, sample_width, cutoff, interval,
+                 leniency, criteria, spacing, window, keep_envelope=False):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.filter = LowPass(cutoff, frame_rate)
+        self.interval = interval
+        self.leniency = leniency
+        self.criteria = criteria
+        self.spacing = spacing
+        self.before, self.after = window
+
+        self.frames = 0
+        # Energy index of the retained frames, see LoudnessIndex.
+        self.offset = 0
+        self.index = np.zeros(1, dtype=energy_index(self._samples(0)).dtype)
+        # Envelope of segments first, first + 1, ...
+        self.first = 0
+        self.times = np.empty(0)
+        self.amplitudes = np.empty(0)
+        # Segments before `decided` have had their peak check.
+        self.decided = 0
+        self.last_peak = 0
+        # Every envelope chunk, when the whole envelope is wanted afterwards.
+        # It is small next to the audio: one float per segment.
+        self.envelope = [] if keep_envelope else None
+
+    def _samples(self, frames):
+        # Shape-only stand-in for the frames decoded so far.
+        zeros = np.zeros((1, self.channels), dtype=DTYPES[self.sample_width])
+        data = np.broadcast_to(zeros, (frames, self.channels))
+        return Samples(data, self.frame_rate, self.sample_width)
+
+    @property
+    def dBFS(self):
+        return LoudnessIndex(self._samples(self.frames), self.index).dBFS
+
+    def feed(self, block):
+        # Returns (time, amplitude) of the peaks that became final.
+        filtered = self.filter.process(block)
+        filtered = np.trunc(filtered).astype(DTYPES[self.sample_width])
+        index = energy_index(
+            Samples(filtered, self.frame_rate, self.sample_width)
+        )
+        self.index = np.concatenate([self.index, self.index[-1] + index[1:]])
+        self.frames += len(filtered)
+        return self._advance(False)
+
+    def finish(self):
+        return self._advance(True)
+
+    def _advance(self, final):
+        samples = self._samples(self.frames)
+        index = LoudnessIndex(samples, self.index, self.offset)
+        length = len(samples)
+
+        # Extend the envelope. Until the end of the track only whole chunks
+        # are final; the last one is cut and padded by the track length.
+        known = self.first + len(self.times)
+        times, amplitudes = index.envelope(
+            self.interval, known * self.interval
+        )
+        if not final:
+            ends = times + self.interval / 2
+            complete = (ends <= length) & \
+                (samples.frame_count(ends) <= self.frames)
+            count = np.count_nonzero(np.logical_and.accumulate(complete))
+            times, amplitudes = times[:count], amplitudes[:count]
+        self.times = np.concatenate([self.times, times])
+        self.amplitudes = np.concatenate([self.amplitudes, amplitudes])
+        if self.envelope is not None:
+            self.envelope.append(amplitudes)
+        known = self.first + len(self.times)
+
+        # Segments that can be decided need their right neighbours and a
+        # loudness window that no longer depends on the track length. Before
+        # the track is `before + after` long, windows starting before zero
+        # still wrap around to the unknown end.
+        start, end = self.decided, known
+        if not final:
+            end = max(start, known - self.leniency)
+            times = self.times[start - self.first:end - self.first]
+            ready = (length >= self.before + self.after) & \
+                (times + self.after <= length) & \
+                (samples.frame_count(times + self.after) <= self.frames)
+            end = start + np.count_nonzero(np.logical_and.accumulate(ready))
+        if end <= start:
+            return []
+
+        context = max(start - self.leniency, 0)
+        stop = min(end + self.leniency, known)
+        times = self.times[start - self.first:end - self.first]
+        loudness = np.full(stop - context, np.nan)
+        loudness[start - context:end - context] = np.abs(
+            index.dbfs(times - self.before, times + self.after)
+        )
+        neighbours = Neighbours(
+            self.amplitudes[context - self.first:stop - self.first],
+            loudness, self.leniency
+        )
+        mask = np.ones(end - start, dtype=bool)
+        for criterion in self.criteria:
+            mask &= criterion(neighbours)[start - context:end - context]
+        # Like detect_peaks, never the first or the last segment.
+        segments = np.arange(start, end)
+        mask &= segments > 0
+        if final:
+            mask &= segments < known - 1
+
+        result = []
+        for i in segments[mask].tolist():
+            time = self.times[i - self.first].item()
+            if time - self.last_peak >= self.spacing:
+                result.append((time, self.amplitudes[i - self.first].item()))
+                self.last_peak = time
+        self.decided = end
+        self._trim()
+        return result
+
+    def _trim(self):
+        drop = max(self.decided - self.leniency, 0) - self.first
+        self.times, self.amplitudes = \
+            self.times[drop:], self.amplitudes[drop:]
+        self.first += drop
+
+        # The next loudness window and the next envelope chunk start here.
+        time = self.decided * self.interval + self.interval / 2
+        ms = max(min(time - self.before, self.decided * self.interval), 0)
+        offset = int(self._samples(0).frame_count(np.float64(ms)))
+        offset = min(offset, self.frames)
+        if offset > self.offset:
+            self.index = self.index[offset - self.offset:]
+            self.offset = offset
+
+
+# Marker mixed into each splice window: a decaying tone of CLICK_FREQUENCY
+# Hz lasting CLICK_MS ms, at CLICK_GAIN of full scale.
+CLICK_MS = 10
+CLICK_FREQUENCY = 2000
+CLICK_GAIN = 0.5
+
+
+def sample_slice(samples, start, end):
+    # Frames of AudioSegment[start:end] for start and end in ms, as a view
+    # when nothing needs padding. Like pydub, a negative start counts from
+    # the end and up to 2 ms past the end are filled with silence.
+    length = len(samples)
+    start, end = min(start, length), min(end, length)
+    if start < 0:
+        start = length - abs(start)
+    first = int(samples.frame_count(np.float64(start)))
+    last = int(samples.frame_count(np.float64(end)))
+    data = samples.data[first:last]
+    missing = (last - first) - len(data)
+    if missing > 0:
+        silence = np.zeros((missing, samples.channels), data.dtype)
+        data = np.concatenate([data, silence])
+    return data
+
+
+def click(samples):
+    t = np.arange(int(samples.frame_rate * CLICK_MS / 1000))
+    t = t / samples.frame_rate
+    sound = np.sin(2 * np.pi * CLICK_FREQUENCY * t) * np.exp(-t * 1000 / 2)
+    sound *= CLICK_GAIN * samples.max_possible_amplitude
+    return sound[:, None]
+
+
+def splice_blocks(samples, windows, clicks=False, crossfade=0):
+    # Yields the (start, end) ms windows of `samples` back to back, in
+    # blocks, without building the result. With `clicks` each window starts
+    # with a click; a `crossfade` in ms overlaps neighbouring windows with
+    # linear fades instead of butting them together.
+    dtype = samples.data.dtype
+    info = np.iinfo(dtype)
+    fade = int(samples.frame_rate * crossfade / 1000)
+    sound = click(samples) if clicks else None
+    pending = np.empty((0, samples.channels))
+    for start, end in windows:
+        block = sample_slice(samples, start, end)
+        if sound is None and not fade:
+            if len(block):
+                yield block
+            continue
+
+        block = block.astype(np.float64)
+        if sound is not None:
+            count = min(len(sound), len(block))
+            block[:count] += sound[:count]
+        overlap = min(fade, len(pending), len(block))
+        if overlap:
+            ramp = ((np.arange(overlap) + 0.5) / overlap)[:, None]
+            block[:overlap] = block[:overlap] * ramp + \
+                pending[len(pending) - overlap:] * (1 - ramp)
+        out = [pending[:len(pending) - overlap]]
+        # The end of the window is held back for the next one to fade into.
+        keep = min(fade, len(block))
+        out.append(block[:len(block) - keep])
+        pending = block[len(block) - keep:]
+        for part in out:
+            if len(part):
+                yield np.clip(np.rint(part), info.min, info.max).astype(dtype)
+    if len(pending):
+        yield np.clip(np.rint(pending), info.min, info.max).astype(dtype)
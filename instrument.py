@@ -0,0 +1,97 @@
+import time
+import threading
+import tracemalloc
+from contextlib import nullcontext
+
+
+class Stats:
+    # Wall time, CPU time and peak traced memory per pipeline stage, plus
+    # item counts. Disabled stats hand out a shared no-op context so the
+    # pipeline can always be instrumented.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+        self.counts = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Thread that started tracemalloc, the only one that resets it.
+        self.tracer = None
+
+    @property
+    def active(self):
+        # Stages being timed on the calling thread, innermost last.
+        return self.local.__dict__.setdefault('active', [])
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def json(self):
+        return {'stages': self.stages, 'counts': self.counts}
+
+
+class Stage:
+    # Stages may nest, e.g. when a lazily computed artifact needs another
+    # one first. The outer stage is paused meanwhile so each stage only
+    # reports its own work. CPU time is the calling thread's. Traced memory
+    # is process-wide, so stages of other threads only read the peak and
+    # never reset it under the thread that traces.
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.wall = self.cpu = 0.0
+        self.memory = 0
+
+    def __enter__(self):
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+            self.stats.tracer = threading.get_ident()
+        if self.stats.active:
+            self.stats.active[-1].pause()
+        self.stats.active.append(self)
+        self.base = tracemalloc.get_traced_memory()[0]
+        self.resume()
+        return self
+
+    def pause(self):
+        self.wall += time.perf_counter() - self.started_wall
+        self.cpu += time.thread_time() - self.started_cpu
+        self.memory = max(
+            self.memory, tracemalloc.get_traced_memory()[1] - self.base
+        )
+
+    def resume(self):
+        if self.stats.tracer == threading.get_ident():
+            tracemalloc.reset_peak()
+        self.started_wall = time.perf_counter()
+        self.started_cpu = time.thread_time()
+
+    def __exit__(self, *exc):
+        self.pause()
+        self.stats.active.pop()
+        if self.tracing:
+            tracemalloc.stop()
+            self.stats.tracer = None
+
+        # Repeated stages add up their times and keep the highest peak.
+        with self.stats.lock:
+            stage = self.stats.stages.setdefault(
+                self.name, {'wall': 0.0, 'cpu': 0.0, 'memory': 0}
+            )
+            stage['wall'] += self.wall
+            stage['cpu'] += self.cpu
+            stage['memory'] = max(stage['memory'], self.memory)
+
+        if self.stats.active:
+            self.stats.active[-1].resume()
+        return False
+
+
+NULL_STAGE = nullcontext()
@@ -1,13 +1,403 @@
-import sys
+import io
 import os
-from pydub import AudioSegment
-from core import Song
+import sys
+import glob
+import json
+import time
+import argparse
+import threading
+import traceback
+import socketserver
+from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    Future, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from instrument import Stats
+
+# pydub (which looks for ffmpeg on import), NumPy and the analysis modules
+# are imported on first conversion, so --help, argument errors and job
+# runners spawning a process per file do not pay for them up front.
+
+
+AUDIO_EXTENSIONS = ('.mp3', '.ogg', '.wav', '.flac', '.m4a')
+
+
+def find_files(paths):
+    # Files, directories (searched recursively) and glob patterns.
+    found = []
+    for path in paths:
+        matches = glob.glob(path, recursive=True) or [path]
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                for root, _, files in os.walk(match):
+                    found += [
+                        os.path.join(root, f) for f in sorted(files)
+                        if f.lower().endswith(AUDIO_EXTENSIONS)
+                    ]
+            else:
+                found.append(match)
+    return list(dict.fromkeys(found))
+
+
+def song_name(filename, parents=0):
+    # The file name without extension, after `parents` of its directories.
+    parts = os.path.normpath(os.path.abspath(filename)).split(os.sep)[1:]
+    return '_'.join(parts[-1 - parents:-1] + [parts[-1].split('.')[0]])
+
+
+def song_names(filenames):
+    # Song names for a batch, which also name its output folders and zip
+    # entries. Files sharing a name, e.g. 01.mp3 of two albums, get their
+    # directories in front until the names differ. Returns the names and
+    # the files that still clash with an earlier one, such as 01.mp3 and
+    # 01.flac side by side.
+    parents = dict.fromkeys(filenames, 0)
+    while True:
+        names = {f: song_name(f, parents[f]) for f in filenames}
+        groups = {}
+        for f in filenames:
+            groups.setdefault(names[f], []).append(f)
+        # Files in one directory would only gain the same prefix.
+        deeper = [
+            f for group in groups.values()
+            if len({os.path.dirname(os.path.abspath(f)) for f in group}) > 1
+            for f in group
+        ]
+        if not deeper:
+            break
+        for f in deeper:
+            parents[f] += 1
+    clashing = [f for group in groups.values() for f in group[1:]]
+    return names, clashing
+
+
+def convert(filename, stream=False, profile=False, package=None, name=None,
+            **params):
+    # `package` is None to export to ./output, a directory to write one zip
+    # per song into, or True to hand back the song's entries as zip bytes
+    # for an archive shared by the whole batch. `name` defaults to the file
+    # name without extension. `params` go to the Song.
+    from cache import AnalysisCache, AudioCache, PCMCache
+    from decode import decode_cached
+    from core import Song
+
+    start = time.perf_counter()
+    stats = Stats(enabled=profile)
+    archive = None
+    try:
+        name = name or song_name(filename)
+        if stream:
+            song = Song.stream(name, filename, stats=stats, **params)
+        else:
+            with stats.stage('decode'):
+                audio = decode_cached(filename, PCMCache())
+            song = Song(
+                name, audio, cache=AnalysisCache(), stats=stats, **params
+            )
+        if package is None:
+            song.export(audio_cache=AudioCache())
+        elif package is True:
+            archive = io.BytesIO()
+            with ZipFile(archive, 'w') as zf:
+                song.package(zf, f'ai_{name}/', AudioCache())
+            archive = archive.getvalue()
+        else:
+            os.makedirs(package, exist_ok=True)
+            with ZipFile(f'{package}/ai_{name}.zip', 'w') as zf:
+                song.package(zf, audio_cache=AudioCache())
+        duration = song.duration
+    except Exception:
+        return filename, 0, time.perf_counter() - start, \
+            traceback.format_exc(), stats.json(), None
+    return filename, duration, time.perf_counter() - start, None, \
+        stats.json(), archive
+
+
+def merge(archive, data):
+    # Copies a worker's entries into the shared archive.
+    with ZipFile(io.BytesIO(data)) as source:
+        for info in source.infolist():
+            archive.writestr(info, source.read(info))
+
+
+def jobs(filenames, workers, stream=False, profile=False, package=None,
+         names=None, **params):
+    # `names` maps filenames to song names, see song_names.
+    names = names or {}
+    if workers == 1 or len(filenames) == 1:
+        for filename in filenames:
+            yield convert(
+                filename, stream, profile, package, names.get(filename),
+                **params
+            )
+        return
+    broken = []
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {
+            pool.submit(
+                convert, f, stream, profile, package, names.get(f), **params
+            ): f
+            for f in filenames
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                broken.append(futures[future])
+    if broken:
+        # A worker died (killed for memory, a crash in the decoder) and
+        # took the pool down. Which file did it is unknown, so everything
+        # left unfinished runs again, each file in a process of its own.
+        with ThreadPoolExecutor(workers) as threads:
+            futures = [
+                threads.submit(
+                    isolated, f, stream, profile, package, names.get(f),
+                    **params
+                )
+                for f in broken
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+def isolated(filename, *args, **params):
+    # convert() in a fresh process, so a crash only fails this file.
+    start = time.perf_counter()
+    with ProcessPoolExecutor(1) as pool:
+        try:
+            return pool.submit(convert, filename, *args, **params).result()
+        except BrokenProcessPool:
+            return filename, 0, time.perf_counter() - start, \
+                'The worker process died while converting this file\n', \
+                {'stages': {}, 'counts': {}}, None
+
+
+def warm():
+    # Imports what conversions need, so the first file of a long-running
+    # process is not slower than the rest.
+    import core
+    import pydub
+
+
+def reply(result, profile=False):
+    filename, duration, elapsed, error, stats, _ = result
+    line = {
+        'file': filename, 'status': 'failed' if error else 'done',
+        'duration': duration, 'elapsed': elapsed, 'error': error
+    }
+    if profile:
+        line['stats'] = stats
+    return json.dumps(line)
+
+
+def worker(socket, jobs, stream=False, profile=False, package=None,
+           **params):
+    # Long-running mode: converts paths read one per line from stdin, or
+    # from connections to a unix socket, answering each with a JSON line.
+    # Modules, caches and worker processes stay warm between files.
+    warm()
+    if jobs > 1:
+        pool = ProcessPoolExecutor(jobs, initializer=warm)
+    else:
+        pool = ThreadPoolExecutor(1)
+    # Files whose worker died, each run again in a process of its own.
+    retries = ThreadPoolExecutor(jobs)
+    replacing = threading.Lock()
+
+    def replace(broken):
+        # A worker died (killed for memory, a crash in the decoder) and
+        # took the pool down. Replaced once, however many jobs report it.
+        nonlocal pool
+        with replacing:
+            if pool is broken:
+                pool = ProcessPoolExecutor(jobs, initializer=warm)
+                broken.shutdown(wait=False)
+
+    def submit(path):
+        # A future of convert()'s result, which is a failure for a file
+        # that crashes its worker rather than an error for every file.
+        args = (path, stream, profile, package)
+        result = Future()
+        current = pool
+        try:
+            future = current.submit(convert, *args, **params)
+        except BrokenProcessPool:
+            replace(current)
+            return submit(path)
+
+        def done(future):
+            try:
+                result.set_result(future.result())
+            except BrokenProcessPool:
+                replace(current)
+                retries.submit(isolated, *args, **params).add_done_callback(
+                    lambda retry: result.set_result(retry.result())
+                )
+        future.add_done_callback(done)
+        return result
+
+    try:
+        if socket is None:
+            lock = threading.Lock()
+
+            def write(future):
+                with lock:
+                    print(reply(future.result(), profile), flush=True)
+
+            for line in sys.stdin:
+                if line.strip():
+                    submit(line.strip()).add_done_callback(write)
+            return 0
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    path = line.decode().strip()
+                    if path:
+                        line = reply(submit(path).result(), profile)
+                        self.wfile.write(f'{line}\n'.encode())
+
+        if os.path.exists(socket):
+            os.remove(socket)
+        with socketserver.ThreadingUnixStreamServer(socket, Handler) as server:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(socket)
+        return 0
+    finally:
+        # Waiting for the last jobs can still replace the pool.
+        current = None
+        while current is not pool:
+            current = pool
+            current.shutdown()
+        retries.shutdown()
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate Beat Saber maps.')
+    parser.add_argument(
+        'paths', nargs='*', help='audio files, directories or glob patterns'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=available_cores(),
+        help='number of worker processes'
+    )
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='decode and analyze in blocks to bound memory on long mixes'
+    )
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='write per-stage timings, memory and counts as JSON'
+    )
+    package = parser.add_mutually_exclusive_group()
+    package.add_argument(
+        '--zip', metavar='PATH', help='write every map into one zip archive'
+    )
+    package.add_argument(
+        '--zip-each', metavar='DIR', help='write one zip archive per map'
+    )
+    parser.add_argument(
+        '--bands', nargs='+', default=(),
+        help='add onsets of these spectral bands to the peaks'
+    )
+    parser.add_argument(
+        '--precision', type=int,
+        help='decimal places kept of note times (default: 4)'
+    )
+    parser.add_argument(
+        '--compat', action='store_true',
+        help='write JSON exactly as json.dumps does'
+    )
+    serve = parser.add_mutually_exclusive_group()
+    serve.add_argument(
+        '--worker', action='store_true',
+        help='keep running and convert paths read one per line from stdin'
+    )
+    serve.add_argument(
+        '--socket', metavar='PATH',
+        help='like --worker, but read paths from a unix socket'
+    )
+    args = parser.parse_args(argv)
+
+    params = {'compat': args.compat, 'bands': tuple(args.bands)}
+    if args.precision is not None:
+        params['precision'] = args.precision
+    if args.bands and args.stream:
+        parser.error('--bands cannot be used with --stream')
+    if args.bands:
+        from spectral import BANDS
+        unknown = set(args.bands) - set(BANDS)
+        if unknown:
+            parser.error(f'unknown bands: {" ".join(sorted(unknown))}')
+
+    if args.worker or args.socket:
+        if args.paths or args.zip:
+            parser.error('a worker takes paths as input and no --zip')
+        return worker(
+            args.socket, max(1, args.jobs), args.stream, bool(args.profile),
+            args.zip_each, **params
+        )
+    if not args.paths:
+        parser.error('no paths given')
+
+    filenames = find_files(args.paths)
+    start = time.perf_counter()
+    failed, seconds, profile = [], 0, {}
+    names, clashing = song_names(filenames)
+    for i, filename in enumerate(clashing, 1):
+        failed.append(filename)
+        print(f'[{i}/{len(filenames)}] failed {filename} (0.0s)')
+        print(
+            f'Its map would be named ai_{names[filename]} like that of '
+            'another file in this batch', file=sys.stderr
+        )
+    results = jobs(
+        [f for f in filenames if f not in clashing], max(1, args.jobs),
+        args.stream, bool(args.profile), True if args.zip else args.zip_each,
+        names, **params
+    )
+    archive = ZipFile(args.zip, 'w') if args.zip else None
+    for i, (filename, duration, elapsed, error, stats, data) in enumerate(
+        results, len(clashing) + 1
+    ):
+        if data is not None:
+            merge(archive, data)
+        profile[filename] = dict(stats, elapsed=elapsed, duration=duration)
+        status = 'failed' if error else 'done'
+        print(f'[{i}/{len(filenames)}] {status} {filename} ({elapsed:.1f}s)')
+        if error:
+            failed.append(filename)
+            print(error, file=sys.stderr)
+        seconds += duration
+    if archive is not None:
+        archive.close()
+
+    if args.profile:
+        with open(args.profile, 'w') as fr:
+            json.dump(profile, fr, indent=2)
+
+    elapsed = time.perf_counter() - start
+    converted = len(filenames) - len(failed)
+    if len(filenames) > 1:
+        print(
+            f'{converted} converted, {len(failed)} failed in {elapsed:.1f}s '
+            f'({converted / elapsed * 60:.1f} songs/min, '
+            f'{seconds / elapsed:.1f} audio-s/s)'
+        )
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
-    filename = sys.argv[1]
-    audio = AudioSegment.from_mp3(filename)
-    song = Song(os.path.basename(filename).split('.')[0], audio)
-    song.export()
+    sys.exit(main(sys.argv[1:]))
 
-# Shoutout to Daniwell
\ No newline at end of file
+# Shoutout to Daniwell
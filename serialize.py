@@ -0,0 +1,82 @@
+import json
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Notes formatted per write, so a chart never exists as one big string.
+CHUNK = 4096
+
+# Decimal places kept of note times, in beats.
+PRECISION = 4
+
+NOTE = (
+    '{"_time":%r,"_lineIndex":%d,"_lineLayer":%d,"_type":%d,'
+    '"_cutDirection":%d}'
+)
+# What json.dumps makes of Note.json(), for byte-identical output.
+COMPAT_NOTE = (
+    '{"_time": %r, "_lineIndex": %d, "_lineLayer": %d, "_type": %d, '
+    '"_cutDirection": %d}'
+)
+
+
+def dumps(obj, compat=False):
+    if compat:
+        return json.dumps(obj).encode()
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def write_json(fr, obj, compat=False):
+    fr.write(dumps(obj, compat))
+
+
+def write_level(fr, chart, compat=False, precision=PRECISION, chunk=CHUNK):
+    # Streams level_json() for `chart` to a binary file. Compat mode gives
+    # exactly json.dumps(level_json()); otherwise separators are compact and
+    # times are rounded to `precision` places (None keeps them whole).
+    if compat:
+        note, separator = COMPAT_NOTE, b', '
+        fr.write(b'{"_events": [], "_notes": [')
+    else:
+        note, separator = NOTE, b','
+        fr.write(b'{"_events":[],"_notes":[')
+
+    for start in range(0, len(chart), chunk):
+        end = start + chunk
+        times = chart.times[start:end]
+        if not compat and precision is not None:
+            times = np.round(np.frombuffer(times), precision).tolist()
+        columns = chart.columns[start:end]
+        rows = chart.rows[start:end]
+        types = chart.types[start:end]
+        directions = chart.directions[start:end]
+        if start:
+            fr.write(separator)
+        if compat or orjson is None:
+            fr.write(separator.decode().join(
+                note % values
+                for values in zip(times, columns, rows, types, directions)
+            ).encode())
+        else:
+            fr.write(orjson.dumps([
+                {
+                    '_time': time,
+                    '_lineIndex': column,
+                    '_lineLayer': row,
+                    '_type': note_type,
+                    '_cutDirection': direction
+                }
+                for time, column, row, note_type, direction in zip(
+                    times, columns, rows, types, directions
+                )
+            ])[1:-1])
+
+    if compat:
+        fr.write(b'], "_obstacles": []}')
+    else:
+        fr.write(b'],"_obstacles":[]}')
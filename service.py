@@ -0,0 +1,402 @@
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import traceback
+from collections import deque
+from urllib.parse import urlsplit, parse_qsl
+from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cache import file_hash
+from main import available_cores, warm
+
+
+HOST = '127.0.0.1'
+PORT = 8000
+
+# Jobs waiting for a worker, beyond one per worker, before requests for new
+# audio are turned away with 503.
+QUEUE = 16
+
+# Largest upload accepted, in bytes.
+MAX_UPLOAD = 256 * 1024 * 1024
+
+# Uploads held in memory at once, from reading the body until the job is
+# done, before further ones get 503.
+UPLOADS = 8
+
+# Most recent requests the latency metrics cover.
+WINDOW = 1000
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable'
+}
+
+
+def flag(value):
+    if value.lower() in ('1', 'true', 'yes', ''):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(value)
+
+
+def names(value):
+    return tuple(name for name in value.split(',') if name)
+
+
+# Song parameters taken from the query string.
+PARAMS = {
+    'bands': names, 'precision': int, 'compat': flag, 'align': flag,
+    'seed': int
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def render(filename, name, archive, params, upload=False):
+    # Runs in a worker process. Returns the map as a zip, or as one JSON
+    # object holding each map file by filename.
+    from pydub import AudioSegment
+    from cache import AnalysisCache, AudioCache, PCMCache
+    from decode import decode_cached
+    from core import Song
+
+    if upload:
+        # Uploads live in temporary files, which would only fill the
+        # PCM cache with entries nobody asks for again.
+        audio = AudioSegment.from_file(filename)
+    else:
+        audio = decode_cached(filename, PCMCache())
+    song = Song(name, audio, cache=AnalysisCache(), **params)
+    out = io.BytesIO()
+    if archive:
+        with ZipFile(out, 'w') as zf:
+            song.package(zf, audio_cache=AudioCache())
+        return out.getvalue()
+    out.write(b'{')
+    for i, (entry, write) in enumerate(song.map_files()):
+        if i:
+            out.write(b',')
+        out.write(json.dumps(entry).encode() + b':')
+        write(out)
+    out.write(b'}')
+    return out.getvalue()
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'max': None}
+    ordered = sorted(values)
+    return {
+        'p50': ordered[len(ordered) // 2],
+        'p95': ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+        'max': ordered[-1]
+    }
+
+
+class Service:
+    # Converts uploads (the request body) and local paths (?path=) with a
+    # pool of worker processes. Identical requests that overlap share one
+    # job, and once `queue` jobs are waiting for a worker, requests for new
+    # jobs get 503 rather than piling up. So do uploads beyond `uploads`,
+    # and any upload while the queue is full, before their body is read.
+    def __init__(self, workers=None, queue=QUEUE, uploads=UPLOADS):
+        self.workers = workers or available_cores()
+        self.capacity = self.workers + queue
+        self.max_uploads = uploads
+        self.uploads = 0
+        self.pool = ProcessPoolExecutor(self.workers, initializer=warm)
+        self.slots = asyncio.Semaphore(self.workers)
+        # Job futures by request key.
+        self.jobs = {}
+        self.queued = 0
+        self.running = 0
+        self.counts = {
+            'requests': 0, 'done': 0, 'failed': 0, 'rejected': 0,
+            'deduplicated': 0, 'restarts': 0
+        }
+        self.latency = deque(maxlen=WINDOW)
+        self.wait = deque(maxlen=WINDOW)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        start = time.perf_counter()
+        headers = {}
+        try:
+            method, path, query, length = await self.read(reader)
+            if path == '/metrics' and method == 'GET':
+                status, content_type, payload = 200, 'application/json', \
+                    json.dumps(self.metrics()).encode()
+            elif path == '/convert' and method == 'POST':
+                self.counts['requests'] += 1
+                if length:
+                    self.admit()
+                    self.uploads += 1
+                try:
+                    body = await self.body(reader, length)
+                    status, content_type, payload, headers = \
+                        await self.convert(query, body)
+                finally:
+                    if length:
+                        self.uploads -= 1
+                self.counts['done'] += 1
+                self.latency.append(time.perf_counter() - start)
+            elif path in ('/metrics', '/convert'):
+                raise HTTPError(405, f'{method} not allowed')
+            else:
+                raise HTTPError(404, f'No such endpoint {path}')
+        except HTTPError as e:
+            status, content_type = e.status, 'application/json'
+            payload = json.dumps({'error': str(e)}).encode()
+            if e.status == 503:
+                headers = {'Retry-After': '1'}
+        except Exception:
+            self.counts['failed'] += 1
+            status, content_type = 500, 'application/json'
+            payload = json.dumps({'error': traceback.format_exc()}).encode()
+
+        head = [
+            f'HTTP/1.1 {status} {REASONS[status]}',
+            f'Content-Type: {content_type}',
+            f'Content-Length: {len(payload)}',
+            'Connection: close'
+        ] + [f'{name}: {value}' for name, value in headers.items()]
+        try:
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+            writer.write(payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def read(self, reader):
+        try:
+            line = await reader.readline()
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            raise HTTPError(400, 'Malformed request')
+        if length > MAX_UPLOAD:
+            raise HTTPError(413, f'Uploads are limited to {MAX_UPLOAD} bytes')
+        url = urlsplit(target)
+        return method, url.path, dict(parse_qsl(url.query, True)), length
+
+    def admit(self):
+        # Turns an upload away before its body is read. It cannot be matched
+        # to a running job without hashing the body, so a full queue means
+        # no.
+        if self.uploads >= self.max_uploads:
+            self.counts['rejected'] += 1
+            raise HTTPError(503, 'Too many uploads, retry later')
+        if len(self.jobs) >= self.capacity:
+            self.counts['rejected'] += 1
+            raise HTTPError(503, 'Too many jobs, retry later')
+
+    async def body(self, reader, length):
+        try:
+            return await reader.readexactly(length) if length else b''
+        except asyncio.IncompleteReadError:
+            raise HTTPError(400, 'Truncated body')
+
+    async def convert(self, query, body):
+        loop = asyncio.get_running_loop()
+        archive = query.pop('format', 'json') == 'zip'
+        source = query.pop('path', None)
+        name = query.pop('name', None)
+        params = self.params(query)
+        if body:
+            content = await loop.run_in_executor(
+                None, lambda: hashlib.sha1(body).hexdigest()
+            )
+            name = name or 'upload'
+        elif source is not None:
+            if not os.path.isfile(source):
+                raise HTTPError(404, f'No such file {source}')
+            content = await loop.run_in_executor(None, file_hash, source)
+            name = name or os.path.basename(source)
+        else:
+            raise HTTPError(400, 'Upload audio or give a path')
+        song = os.path.basename(name).split('.')[0]
+
+        key = (content, song, archive, tuple(sorted(params.items())))
+        job = self.jobs.get(key)
+        if job is not None:
+            self.counts['deduplicated'] += 1
+        else:
+            if len(self.jobs) >= self.capacity:
+                self.counts['rejected'] += 1
+                raise HTTPError(503, 'Too many jobs, retry later')
+            job = asyncio.ensure_future(
+                self.run(source, body, name, song, archive, params)
+            )
+            self.jobs[key] = job
+            job.add_done_callback(lambda _: self.jobs.pop(key, None))
+        # Shielded, so one client going away does not cancel the others.
+        payload = await asyncio.shield(job)
+
+        if archive:
+            return 200, 'application/zip', payload, {
+                'Content-Disposition':
+                    f'attachment; filename="ai_{song}.zip"'
+            }
+        return 200, 'application/json', payload, {}
+
+    def params(self, query):
+        params = {}
+        for name, value in query.items():
+            if name not in PARAMS:
+                raise HTTPError(400, f'Unknown parameter {name}')
+            try:
+                params[name] = PARAMS[name](value)
+            except ValueError:
+                raise HTTPError(400, f'Bad value for {name}: {value}')
+        if params.get('bands'):
+            from spectral import BANDS
+            unknown = set(params['bands']) - set(BANDS)
+            if unknown:
+                raise HTTPError(
+                    400, f'Unknown bands: {" ".join(sorted(unknown))}'
+                )
+        return params
+
+    async def run(self, source, body, name, song, archive, params):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        self.wait.append(time.perf_counter() - start)
+        self.running += 1
+        upload = None
+        try:
+            if body:
+                upload = await loop.run_in_executor(
+                    None, save_upload, body, os.path.splitext(name)[1]
+                )
+            args = (
+                render, upload or source, song, archive, params,
+                upload is not None
+            )
+            pool = self.pool
+            try:
+                return await loop.run_in_executor(pool, *args)
+            except BrokenProcessPool:
+                # A worker died (killed for memory, a crash in the decoder)
+                # and took the pool down with every job on it. The pool is
+                # replaced, and each of those jobs runs once more in a
+                # process of its own, so only the one that crashes fails.
+                self.replace(pool)
+            alone = ProcessPoolExecutor(1, initializer=warm)
+            try:
+                return await loop.run_in_executor(alone, *args)
+            except BrokenProcessPool:
+                self.counts['failed'] += 1
+                raise HTTPError(
+                    500, 'The worker process died while converting this file'
+                )
+            finally:
+                alone.shutdown(wait=False)
+        finally:
+            self.running -= 1
+            self.slots.release()
+            if upload is not None:
+                os.remove(upload)
+
+    def replace(self, broken):
+        # Once per broken pool, however many of its jobs report it.
+        if self.pool is broken:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=warm)
+            self.counts['restarts'] += 1
+            broken.shutdown(wait=False)
+
+    def metrics(self):
+        return dict(
+            self.counts, workers=self.workers, capacity=self.capacity,
+            jobs=len(self.jobs), queued=self.queued, running=self.running,
+            uploads=self.uploads,
+            latency=percentiles(self.latency), wait=percentiles(self.wait)
+        )
+
+
+def save_upload(body, suffix):
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix='beat-ai-')
+    with os.fdopen(fd, 'wb') as fr:
+        fr.write(body)
+    return path
+
+
+async def serve(host=HOST, port=PORT, workers=None, queue=QUEUE,
+                uploads=UPLOADS):
+    service = Service(workers, queue, uploads)
+    server = await asyncio.start_server(service.handle, host, port)
+    host, port = server.sockets[0].getsockname()[:2]
+    print(f'Listening on http://{host}:{port}', flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Serve map generation over HTTP. POST audio (or '
+        '?path= a local file) to /convert, optionally with ?format=zip; '
+        'GET /metrics for queue depth and latency.'
+    )
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument(
+        '--port', type=int, default=PORT, help='0 picks a free port'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=available_cores(),
+        help='number of worker processes'
+    )
+    parser.add_argument(
+        '--queue', type=int, default=QUEUE,
+        help='jobs waiting for a worker before new ones get 503'
+    )
+    parser.add_argument(
+        '--uploads', type=int, default=UPLOADS,
+        help='uploads held in memory at once before new ones get 503'
+    )
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(
+            args.host, args.port, max(1, args.jobs), args.queue,
+            max(1, args.uploads)
+        ))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
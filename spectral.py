@@ -0,0 +1,105 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from data import NoteType
+from dsp import space_peaks
+
+
+class Band:
+    def __init__(self, name, low, high, note_type=None, row=None):
+        self.name = name
+        # Frequency range in Hz.
+        self.low, self.high = low, high
+        # Preferred note for onsets in this band, if any.
+        self.note_type = note_type
+        self.row = row
+
+
+BANDS = {
+    'kick': Band('kick', 40, 150, NoteType.red, 0),
+    'snare': Band('snare', 150, 2500, NoteType.blue, 1),
+    'hihat': Band('hihat', 6000, 16000, NoteType.blue, 2),
+    'vocal': Band('vocal', 300, 3400)
+}
+
+# STFT size in frames and hop in ms.
+WINDOW = 2048
+HOP = 10
+
+# STFT frames transformed at once, to bound memory on long tracks.
+CHUNK = 1024
+
+# Onset picking, in hops: a flux frame is an onset when it is the maximum of
+# PEAK_WINDOW hops either side and exceeds the mean of AVERAGE_WINDOW hops
+# either side by DELTA (flux normalized per band to 0..1).
+PEAK_WINDOW = 3
+AVERAGE_WINDOW = 10
+DELTA = 0.07
+
+# Minimum time between onsets of a band, in ms.
+WAIT = 50
+
+
+def band_flux(samples, bands, window=WINDOW, hop=HOP, chunk=CHUNK):
+    # Spectral flux per band from one windowed FFT over the track. Returns
+    # the frame centre times in ms and a (frames, bands) array.
+    rate = samples.frame_rate
+    step = max(1, int(rate * hop / 1000))
+    data = samples.data
+    count = max(0, (len(data) - window) // step + 1)
+
+    freqs = np.fft.rfftfreq(window, 1 / rate)
+    weights = np.stack(
+        [(freqs >= band.low) & (freqs < band.high) for band in bands], axis=1
+    ).astype(np.float64)
+    hann = np.hanning(window)
+
+    flux = np.empty((count, len(bands)))
+    previous = None
+    for start in range(0, count, chunk):
+        stop = min(start + chunk, count)
+        block = data[start * step:(stop - 1) * step + window]
+        mono = block.mean(axis=1)
+        frames = sliding_window_view(mono, window)[::step] * hann
+        magnitude = np.abs(np.fft.rfft(frames, axis=1))
+        if previous is None:
+            previous = magnitude[:1]
+        rise = np.diff(np.concatenate([previous, magnitude]), axis=0)
+        flux[start:stop] = np.maximum(rise, 0) @ weights
+        previous = magnitude[-1:]
+
+    times = (np.arange(count) * step + window / 2) * 1000 / rate
+    return times, flux
+
+
+def pick_onsets(times, flux, wait=WAIT):
+    # Indices of the onsets in one band's flux.
+    if not len(flux):
+        return []
+    flux = flux / (flux.max() or 1)
+    size = 2 * PEAK_WINDOW + 1
+    padded = np.pad(flux, PEAK_WINDOW, constant_values=-np.inf)
+    local_max = sliding_window_view(padded, size).max(axis=1)
+
+    # Moving mean from a cumulative sum, clipped at the ends.
+    total = np.concatenate([[0.0], np.cumsum(flux)])
+    positions = np.arange(len(flux))
+    first = np.maximum(positions - AVERAGE_WINDOW, 0)
+    last = np.minimum(positions + AVERAGE_WINDOW + 1, len(flux))
+    mean = (total[last] - total[first]) / (last - first)
+
+    mask = (flux == local_max) & (flux >= mean + DELTA) & (flux > 0)
+    return space_peaks(times, mask, wait)
+
+
+def onsets(samples, names, window=WINDOW, hop=HOP):
+    # (time, strength, band name) for every band in `names`, by time.
+    bands = [BANDS[name] for name in names]
+    times, flux = band_flux(samples, bands, window, hop)
+    found = []
+    for column, band in enumerate(bands):
+        strength = flux[:, column] / (flux[:, column].max() or 1)
+        found += [
+            (times[i].item(), strength[i].item(), band.name)
+            for i in pick_onsets(times, flux[:, column])
+        ]
+    return sorted(found)
@@ -0,0 +1,161 @@
+import sys
+import csv
+import json
+import argparse
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from core import Segment, CUTOFF, POLLING_INTERVAL, LENIENCY, SPACING, \
+    LOUDNESS_WINDOW, generate_chart, pick_bpm
+from data import difficulties
+from dsp import LoudnessIndex, Neighbours, as_samples, low_pass, \
+    space_peaks, louder_than_neighbours, distinct_from_neighbours, \
+    above_loudness
+from tempo import estimate_tempo
+from cache import PCMCache
+from decode import decode_samples
+
+
+# The defaults of each parameter in the middle of its grid.
+GRID = {
+    'interval': [5, POLLING_INTERVAL, 20],
+    'leniency': [4, LENIENCY, 12],
+    'distinct': [0.5, 0.75, 0.9],
+    'loudness': [0.25, 0.5, 0.75],
+    'spacing': [SPACING, 50, 100]
+}
+
+COLUMNS = [
+    'interval', 'leniency', 'distinct', 'loudness', 'spacing', 'peaks',
+    'peaks_per_second', 'bpm', 'notes_per_second'
+]
+
+
+def sweep(audio, grid=GRID, cutoff=CUTOFF, charts=False, workers=None):
+    # Decodes and filters once. Every envelope comes from the cumulative
+    # energy index, which is the per-frame envelope aggregated to any
+    # interval exactly, so each setting matches a Song built with it.
+    index = LoudnessIndex(low_pass(as_samples(audio), cutoff))
+    duration = len(audio) / 1000
+    with ThreadPoolExecutor(workers) as pool:
+        rows = pool.map(
+            lambda interval: _sweep_interval(
+                index, interval, grid, duration, charts
+            ),
+            grid['interval']
+        )
+        return [row for interval in rows for row in interval]
+
+
+def _sweep_interval(index, interval, grid, duration, charts):
+    times, amplitudes = index.envelope(interval)
+    before, after = LOUDNESS_WINDOW
+    loudness = np.abs(index.dbfs(times - before, times + after))
+    tempo = estimate_tempo(amplitudes, interval)
+
+    rows = []
+    for leniency in grid['leniency']:
+        # Each criterion is evaluated once per ratio and combined per
+        # setting, instead of redoing the neighbourhood for every one.
+        neighbours = Neighbours(amplitudes, loudness, leniency)
+        louder = np.zeros(len(amplitudes), dtype=bool)
+        louder[1:-1] = louder_than_neighbours(neighbours)[1:-1]
+        distinct = {
+            ratio: distinct_from_neighbours(ratio)(neighbours)
+            for ratio in grid['distinct']
+        }
+        loud = {
+            ratio: above_loudness(ratio)(neighbours)
+            for ratio in grid['loudness']
+        }
+        for d, l, spacing in product(
+            grid['distinct'], grid['loudness'], grid['spacing']
+        ):
+            mask = louder & distinct[d] & loud[l]
+            found = space_peaks(times, mask, spacing)
+            row = {
+                'interval': interval, 'leniency': leniency, 'distinct': d,
+                'loudness': l, 'spacing': spacing, 'peaks': len(found),
+                'peaks_per_second': len(found) / duration if duration else 0,
+                'bpm': None, 'notes_per_second': None
+            }
+            try:
+                row['bpm'] = pick_bpm(tempo, times[found].tolist())
+            except IndexError:
+                # Unsure tempo and too few peaks for the median.
+                pass
+            if charts and found and row['bpm'] is not None:
+                row['notes_per_second'] = _density(
+                    times[found], amplitudes[found], row['bpm'], duration
+                )
+            rows.append(row)
+    return rows
+
+
+def _density(times, amplitudes, bpm, duration):
+    peaks = [
+        Segment(time, amplitude)
+        for time, amplitude in zip(times.tolist(), amplitudes.tolist())
+    ]
+    chart = generate_chart(peaks, bpm, difficulties['Expert'])
+    return len(chart) / duration if duration else 0
+
+
+def format_table(rows):
+    def cell(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return f'{value:.2f}'
+        return str(value)
+
+    cells = [COLUMNS] + [[cell(row[c]) for c in COLUMNS] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(COLUMNS))]
+    return '\n'.join(
+        '  '.join(value.rjust(width) for value, width in zip(line, widths))
+        for line in cells
+    )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Peak detection results over a grid of parameters.'
+    )
+    parser.add_argument('path', help='audio file')
+    for name, values in GRID.items():
+        parser.add_argument(
+            f'--{name}', nargs='+', default=values,
+            type=int if name in ('interval', 'leniency') else float,
+            help=f'values to try (default: {" ".join(map(str, values))})'
+        )
+    parser.add_argument('--cutoff', type=float, default=CUTOFF)
+    parser.add_argument(
+        '--charts', action='store_true',
+        help='also build the Expert chart per setting for its note density'
+    )
+    parser.add_argument(
+        '--sort', choices=COLUMNS, help='order rows by this column'
+    )
+    parser.add_argument('--output', help='write rows as .csv or .json')
+    args = parser.parse_args(argv)
+
+    audio = decode_samples(args.path, PCMCache())
+    grid = {name: getattr(args, name) for name in GRID}
+    rows = sweep(audio, grid, args.cutoff, args.charts)
+    if args.sort:
+        rows.sort(key=lambda row: (row[args.sort] is None, row[args.sort]))
+    print(format_table(rows))
+
+    if args.output:
+        with open(args.output, 'w', newline='') as fr:
+            if args.output.endswith('.json'):
+                json.dump(rows, fr, indent=2)
+            else:
+                writer = csv.DictWriter(fr, COLUMNS)
+                writer.writeheader()
+                writer.writerows(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
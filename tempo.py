@@ -0,0 +1,109 @@
+import numpy as np
+
+
+# Range of tempos considered, in beats per minute.
+TEMPO_RANGE = (50, 200)
+
+# Log-normal preference for tempos near PRIOR_BPM, with a spread of
+# PRIOR_OCTAVES octaves, to settle half and double tempo ambiguities.
+PRIOR_BPM = 120
+PRIOR_OCTAVES = 1.4
+
+# Weight of the autocorrelation at twice and three times the beat period.
+HARMONICS = (0.5, 0.25)
+
+# Multiples of the period used to refine it.
+MULTIPLES = 16
+
+# Beats from the start used to find the phase.
+PHASE_BEATS = 32
+
+
+def novelty(envelope):
+    # Frame to frame change of the loudness envelope in dB. Silent segments
+    # (infinite dB) count as the quietest finite level.
+    envelope = np.asarray(envelope, dtype=np.float64)
+    finite = np.isfinite(envelope)
+    if not finite.any():
+        return np.zeros(max(len(envelope) - 1, 0))
+    envelope = np.where(finite, envelope, envelope[finite].max())
+    change = np.abs(np.diff(envelope))
+    return change - change.mean() if len(change) else change
+
+
+def autocorrelation(x):
+    # Normalized so lag 0 is 1, through one FFT instead of O(n^2) sums.
+    if not len(x) or not x.any():
+        return np.zeros(len(x))
+    spectrum = np.fft.rfft(x, 2 * len(x))
+    result = np.fft.irfft(spectrum * spectrum.conj())[:len(x)]
+    return result / result[0]
+
+
+def estimate_tempo(envelope, interval, tempo_range=TEMPO_RANGE):
+    # Tempo from an envelope sampled every `interval` ms, starting at
+    # interval / 2 like Song.segments. Returns (bpm, confidence, phase):
+    # confidence is the normalized autocorrelation at the beat period, and
+    # phase the time of the first beat in ms. bpm is None when the envelope
+    # is too short to hold two beats.
+    x = novelty(envelope)
+    low, high = tempo_range
+    shortest = int(np.floor(60000 / high / interval))
+    longest = int(np.ceil(60000 / low / interval))
+    if len(x) <= max(2 * longest, shortest + 1):
+        return None, 0.0, 0.0
+    ac = autocorrelation(x)
+
+    # Tempogram over the lags of the tempo range, with harmonics and prior.
+    # Each lag takes the best of its neighbours, since a period rarely
+    # falls on a whole number of frames.
+    wide = np.maximum(ac, np.maximum(np.roll(ac, 1), np.roll(ac, -1)))
+    lags = np.arange(max(shortest, 1), longest + 1)
+    score = wide[lags].copy()
+    for multiple, weight in enumerate(HARMONICS, 2):
+        harmonic = lags * multiple
+        valid = harmonic < len(ac)
+        score[valid] += weight * wide[harmonic[valid]]
+    bpms = 60000 / (lags * interval)
+    score *= np.exp(-0.5 * (np.log2(bpms / PRIOR_BPM) / PRIOR_OCTAVES) ** 2)
+    best = int(np.argmax(score))
+    lag = float(lags[best])
+
+    lag = refine_period(ac, lag)
+    bpm = 60000 / (lag * interval)
+    confidence = float(np.clip(ac[lags[best]], 0, 1))
+    phase = (beat_phase(x, lag) + 1) * interval % (lag * interval)
+    return float(np.clip(bpm, low, high)), confidence, float(phase)
+
+
+def refine_period(ac, lag, multiples=MULTIPLES):
+    # The autocorrelation peaks again at every multiple of the period, so
+    # a line through the peaks near k * lag pins it down far more finely
+    # than the first one alone.
+    found, peaks = [], []
+    for k in range(1, multiples + 1):
+        centre = int(round(k * lag))
+        if centre + 2 >= len(ac):
+            break
+        i = centre - 1 + int(np.argmax(ac[centre - 1:centre + 2]))
+        left, middle, right = ac[i - 1:i + 2]
+        curvature = left - 2 * middle + right
+        offset = 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+        found.append(k)
+        peaks.append(i + offset)
+        # Later multiples are searched around the refined period.
+        lag = np.dot(found, peaks) / np.dot(found, found)
+    return float(lag)
+
+
+def beat_phase(x, period, beats=PHASE_BEATS):
+    # Offset in frames of the comb of `period` that collects the most
+    # novelty over the first `beats` beats, where a small error in the
+    # period has not drifted far yet.
+    x = np.maximum(x, 0)
+    count = min(int((len(x) - 1) // period) + 1, beats)
+    beats = np.arange(count) * period
+    phases = np.arange(int(np.ceil(period)))
+    positions = np.rint(phases[:, None] + beats[None, :]).astype(np.int64)
+    positions = np.minimum(positions, len(x) - 1)
+    return int(np.argmax(x[positions].sum(axis=1)))